@@ -4,6 +4,7 @@ from pathlib import Path
 __version__ = version(__package__)
 
 DATA_DIR = Path(__file__).parent.absolute() / "data"
+CACHE_DIR = DATA_DIR / "cache"
 EPSG = 2272
 
 # Where we upload data files to s3
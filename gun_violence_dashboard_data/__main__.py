@@ -1,41 +1,77 @@
 """The main command line module that defines the "gv_dashboard_data" tool."""
 
 import datetime
+from pathlib import Path
 
 import click
-import simplejson as json
 from loguru import logger
 
-from . import DATA_DIR
-from .courts import run as run_courts_scraper
-from .geo import (
-    get_council_districts,
-    get_neighborhoods,
-    get_pa_house_districts,
-    get_pa_senate_districts,
-    get_police_districts,
-    get_school_catchments,
-    get_zip_codes,
-)
-from .homicides import PPDHomicideTotal
-from .shootings import ShootingVictimsData, load_existing_shootings_data
-from .streets import StreetHotSpots
+from . import CACHE_DIR, DATA_DIR
+from .pipeline import PIPELINE_STAGES
+
+# NOTE: each command imports the modules it needs when it runs, so that
+# starting the CLI (e.g., for --help) doesn't load all of the heavy
+# dependencies; see "gv-dashboard-data benchmark startup"
 
 
 @click.group()
 @click.version_option()
-def cli():
+@click.option(
+    "--offline",
+    is_flag=True,
+    envvar="GV_DASHBOARD_OFFLINE",
+    help="Whether to only use cached boundary layers.",
+)
+@click.option(
+    "--boundary-cache-ttl",
+    type=float,
+    default=None,
+    envvar="GV_DASHBOARD_BOUNDARY_TTL",
+    help="Max age (in seconds) of cached boundary layers, if the server can't revalidate them.",
+)
+@click.option(
+    "--http-mode",
+    type=click.Choice(["record", "replay"]),
+    default=None,
+    envvar="GV_DASHBOARD_HTTP_MODE",
+    help="Whether to record HTTP responses, or replay recorded responses instead of using the network.",
+)
+@click.option(
+    "--http-fixtures",
+    type=click.Path(file_okay=False),
+    default=None,
+    envvar="GV_DASHBOARD_HTTP_FIXTURES",
+    help="Where recorded HTTP responses are saved.",
+)
+def cli(offline=False, boundary_cache_ttl=None, http_mode=None, http_fixtures=None):
     """Processing data for the Controller's Office gun violence dashboard.
 
     https://nickhand.dev/philly-gun-violence-map
     """
-    pass
+    # Configure the boundary cache
+    if offline or boundary_cache_ttl is not None:
+        from .geo import BOUNDARY_CACHE
+
+        BOUNDARY_CACHE.offline = offline
+        if boundary_cache_ttl is not None:
+            BOUNDARY_CACHE.ttl = boundary_cache_ttl
+
+    # Record or replay HTTP responses
+    if http_mode is not None:
+        from .recording import HTTP_RECORDER
+
+        HTTP_RECORDER.mode = http_mode
+        if http_fixtures is not None:
+            HTTP_RECORDER.path = Path(http_fixtures)
+        HTTP_RECORDER.install()
 
 
 @cli.command()
 @click.option("--debug", is_flag=True)
 def save_geojson_layers(debug=False):
     """Save the various geojson layers needed in the dashboard."""
+    from .geo import BOUNDARY_FUNCS
+    from .streets import StreetHotSpots
 
     # ------------------------------------------------
     # Part 1: Hot spot streets
@@ -43,18 +79,7 @@ def save_geojson_layers(debug=False):
     hotspots = StreetHotSpots(debug=debug)
     hotspots.save()
 
-    # Functions
-    geo_funcs = [
-        get_zip_codes,
-        get_police_districts,
-        get_council_districts,
-        get_neighborhoods,
-        get_school_catchments,
-        get_pa_house_districts,
-        get_pa_senate_districts,
-    ]
-
-    for func in geo_funcs:
+    for func in BOUNDARY_FUNCS:
 
         tag = func.__name__.split("get_")[-1]
         filename = f"{tag}.geojson"
@@ -66,6 +91,22 @@ def save_geojson_layers(debug=False):
         func().to_crs(epsg=4326).to_file(path, driver="GeoJSON")
 
 
+@cli.command()
+@click.option("--debug", is_flag=True)
+@click.option(
+    "--force", is_flag=True, help="Whether to rebuild even if no boundaries changed."
+)
+def build_geo_overlay(debug=False, force=False):
+    """Build the overlay of all boundary layers used to label shootings."""
+    from .geo import get_boundary_overlay
+
+    if debug:
+        logger.debug("Building overlay of boundary layers")
+
+    overlay = get_boundary_overlay(rebuild=force)
+    logger.info(f"Boundary overlay has {len(overlay)} units")
+
+
 @cli.command()
 @click.option("--debug", is_flag=True, help="Whether to log debug statements.")
 @click.option(
@@ -82,12 +123,43 @@ def save_geojson_layers(debug=False):
     is_flag=True,
     help="Whether to force the homicide update.",
 )
+@click.option(
+    "--full",
+    is_flag=True,
+    help="Whether to re-process all shootings, rather than only new or changed rows.",
+)
+@click.option(
+    "--strict-rowwise",
+    is_flag=True,
+    help="Whether to validate each row of the shootings data with pydantic.",
+)
+@click.option(
+    "--memory-report",
+    is_flag=True,
+    help="Whether to trace the peak memory allocated by each stage of the update.",
+)
+@click.option(
+    "--profile-stage",
+    default=None,
+    help="The name of a stage to profile with cProfile, e.g., 'enrich:streets'.",
+)
+@click.option(
+    "--from-stage",
+    type=click.Choice(PIPELINE_STAGES),
+    default=None,
+    help="Force the shootings update to rerun from this stage, rather than resuming from saved checkpoints.",
+)
 def daily_update(
     debug=False,
     ignore_checks=False,
     homicides_only=False,
     shootings_only=False,
     force_homicide_update=False,
+    full=False,
+    strict_rowwise=False,
+    memory_report=False,
+    profile_stage=None,
+    from_stage=None,
 ):
     """Run the daily pre-processing update.
 
@@ -104,52 +176,120 @@ def daily_update(
         5. Save the cumulative daily shooting victims total.
 
         6. Scrape and save the homicide count from the PPD's website.
+
+    The homicide and shooting updates run concurrently, and each update
+    that succeeds is recorded in "meta.json", even if the other fails. The
+    shootings update is skipped if its inputs are unchanged since the last
+    update, but the time it was checked is still recorded.
+
+    The shootings update is split into stages, whose outputs are
+    checkpointed: a rerun skips the stages whose inputs are unchanged, so
+    it resumes from the stage that failed.
+
+    When replaying HTTP responses, the outputs and "meta.json" are saved
+    next to the recorded responses instead, and nothing is uploaded.
+
+    The time and memory used by each stage of the update are saved to
+    the cache, named by the parts that ran, e.g.,
+    "pipeline_report_shootings.json".
     """
+    from .profiling import REPORT
+    from .recording import HTTP_RECORDER
+    from .update import run_concurrently, update_json
+
+    # Configure the pipeline report
+    REPORT.trace_memory = memory_report
+    REPORT.profile_stage = profile_stage
+
     # Do all parts
     process_all = not (homicides_only or shootings_only)
 
-    # Initialize meta
-    meta = {}
+    # Only import the parts that run
+    # NOTE: import before starting any threads
+    if process_all or homicides_only:
+        from .homicides import PPDHomicideTotal
+    if process_all or shootings_only:
+        from .shootings import ShootingVictimsData
+
+    # The time of the update
     now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
     # ------------------------------------------------------
     # Part 1: Homicide count scraped from PPD
     # ------------------------------------------------------
-    if process_all or homicides_only:
+    def update_homicides():
 
         # Run the update
-        homicide_count = PPDHomicideTotal(debug=debug)
-        homicide_count.update(force=force_homicide_update)
+        with REPORT.stage("homicides"):
+            homicide_count = PPDHomicideTotal(debug=debug)
+            homicide_count.update(force=force_homicide_update)
 
         # Update the meta
-        meta["last_updated_homicides"] = now
+        return {"last_updated_homicides": now}
 
     # ---------------------------------------------------
     # Part 2: Main shooting victims data file
     # ---------------------------------------------------
-    if process_all or shootings_only:
-        victims = ShootingVictimsData(debug=debug, ignore_checks=ignore_checks)
-        data = victims.get()
-
-        # Save victims data to annual files
-        victims.save(data)
+    def update_shootings():
+        victims = ShootingVictimsData(
+            debug=debug,
+            ignore_checks=ignore_checks,
+            full=full,
+            strict_rowwise=strict_rowwise,
+        )
+
+        # Check if the upstream data has changed before downloading
+        with REPORT.stage("fingerprint"):
+            fingerprint = victims.get_fingerprint()
+        if from_stage is None and not victims.has_changed(fingerprint):
+            logger.info("Shooting victims data is unchanged; skipping update")
+            return {"last_checked_shootings": now}
+
+        # Process, save and upload the victims data, resuming if possible
+        victims.run(fingerprint, from_stage=from_stage)
 
         # Update the meta
-        meta["last_updated_shootings"] = now
+        return {
+            "last_checked_shootings": now,
+            "last_updated_shootings": now,
+            "shootings_fingerprint": fingerprint,
+        }
+
+    # Run both parts at the same time, since they don't depend on each other
+    # NOTE: memory tracing only works if the parts run one at a time
+    parts = []
+    if process_all or homicides_only:
+        parts.append(update_homicides)
+    if process_all or shootings_only:
+        parts.append(update_shootings)
+    results = run_concurrently(parts, max_workers=1 if memory_report else None)
 
-    # Update meta data
+    # Update meta data for the parts that succeeded, removing the old key
+    meta = {}
+    errors = []
+    for func, result in zip(parts, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to run {func.__name__}: {result!r}")
+            errors.append(result)
+        else:
+            meta.update(result)
+
+    # Never record a replayed update in the real meta data
     meta_path = DATA_DIR / "meta.json"
-    existing_meta = json.load(meta_path.open(mode="r"))
+    if HTTP_RECORDER.mode == "replay":
+        meta_path = HTTP_RECORDER.output_dir / "meta.json"
+        meta_path.parent.mkdir(parents=True, exist_ok=True)
+    update_json(meta_path, meta, remove=["last_updated"])
 
-    # Remove old key
-    if "last_updated" in existing_meta:
-        existing_meta.pop("last_updated")
+    # Save the pipeline report, named by the parts that ran
+    # NOTE: the report is kept in the cache, so it isn't committed
+    name = "_".join(func.__name__.split("_")[-1] for func in parts)
+    REPORT.log()
+    REPORT.save(CACHE_DIR / f"pipeline_report_{name}.json")
 
-    # Add new info
-    existing_meta.update(meta)
-
-    # Save the download time
-    json.dump(existing_meta, meta_path.open(mode="w"))
+    # Fail if any part failed
+    if errors:
+        raise errors[0]
 
 
 @cli.command()
@@ -191,8 +331,11 @@ def scrape_courts_portal(
     """
     Scrape courts information from the PA's Unified Judicial System's portal.
     """
+    from .courts import run as run_courts_scraper
+    from .shootings import load_existing_shootings_data
+
     # Load the existing data
-    shootings = load_existing_shootings_data()
+    shootings = load_existing_shootings_data(columns=["dc_key"])
 
     # Run the scraper
     run_courts_scraper(
@@ -207,5 +350,101 @@ def scrape_courts_portal(
     )
 
 
+@cli.group()
+def benchmark():
+    """Run the offline benchmarks of the daily update."""
+
+
+@benchmark.command("run")
+@click.option(
+    "--rows",
+    type=int,
+    multiple=True,
+    default=[10000, 100000],
+    show_default=True,
+    help="The number of synthetic shootings to benchmark; can be repeated.",
+)
+@click.option(
+    "--repeat", type=int, default=3, show_default=True, help="The number of runs."
+)
+@click.option("--seed", type=int, default=42, help="Random seed for the data.")
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Where to save the results; defaults to the cache, named by commit.",
+)
+def run_benchmarks(rows, repeat=3, seed=42, output=None):
+    """Time the hot paths of the daily update on synthetic data, offline."""
+    from .benchmarks import BENCHMARKS_DIR, BenchmarkSuite, save_results
+
+    results = BenchmarkSuite(sizes=list(rows), repeat=repeat, seed=seed).run()
+
+    # Save
+    if output is None:
+        output = BENCHMARKS_DIR / f"{results['commit'] or 'local'}.json"
+    save_results(results, output)
+    logger.info(f"Saved benchmark results to {output}")
+
+
+@benchmark.command("compare")
+@click.argument("old", type=click.Path(exists=True, dir_okay=False))
+@click.argument("new", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--threshold",
+    type=float,
+    default=0.1,
+    show_default=True,
+    help="The relative increase in time that counts as a slowdown.",
+)
+def compare_benchmarks(old, new, threshold=0.1):
+    """Compare two benchmark results, failing if any benchmark slowed down."""
+    from .benchmarks import compare_results, load_results
+
+    comparison = compare_results(load_results(old), load_results(new), threshold)
+    click.echo(comparison.to_string(index=False, float_format="{:.3f}".format))
+
+    slowdowns = comparison["slowdown"].sum()
+    if slowdowns:
+        raise click.ClickException(
+            f"{slowdowns} benchmark(s) slowed down by more than {threshold:.0%}"
+        )
+
+
+@benchmark.command("startup")
+@click.option(
+    "--budget",
+    type=float,
+    default=None,
+    help="The max total import time, in seconds; defaults to STARTUP_BUDGET.",
+)
+@click.option(
+    "--repeat", type=int, default=5, show_default=True, help="The number of runs."
+)
+@click.argument("args", nargs=-1)
+def benchmark_startup(budget=None, repeat=5, args=()):
+    """Check the import time of running the tool (with "--help" by default),
+    failing if it's over budget or loads heavy dependencies.
+
+    Pass the arguments to time after "--", e.g., "startup -- daily-update --help".
+    Note that "--help" doesn't run the command, so the imports of the command
+    itself aren't checked.
+    """
+    from .benchmarks import STARTUP_BUDGET, check_startup, time_startup
+
+    if budget is None:
+        budget = STARTUP_BUDGET
+
+    # Time the imports, and show the slowest top-level ones
+    imports = time_startup(args=args or ("--help",), repeat=repeat)
+    slowest = imports.query("depth == 0").nlargest(10, "cumulative")
+    click.echo(slowest.to_string(index=False, float_format="{:.4f}".format))
+    click.echo(f"Total import time: {imports['self'].sum():.3f}s")
+
+    problems = check_startup(imports, budget=budget)
+    if problems:
+        raise click.ClickException("; ".join(problems))
+
+
 if __name__ == "__main__":
     cli(prog_name="gv_dashboard_data")
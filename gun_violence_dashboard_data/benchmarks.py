@@ -0,0 +1,541 @@
+"""Offline benchmarks for the hot paths of the daily update, and the
+startup time of the command line tool."""
+
+import gzip
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from unittest import mock
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+import simplejson as json
+from loguru import logger
+
+from . import CACHE_DIR, EPSG, geo, shootings
+from .courts import merge as merge_court_info
+from .geo import get_city_limits, get_xy
+from .s3 import S3Publisher
+from .streets import StreetHotSpots
+from .utils import validate_columns
+
+# Where benchmark results are saved by default
+BENCHMARKS_DIR = CACHE_DIR / "benchmarks"
+
+# The number of boundaries in each synthetic layer, roughly matching the real ones
+BOUNDARY_SIZES = {
+    "zip_code": 48,
+    "police_district": 21,
+    "council_district": 10,
+    "neighborhood": 158,
+    "school_name": 150,
+    "house_district": 26,
+    "senate_district": 8,
+}
+
+# The max time to import everything needed for "gv-dashboard-data --help", in seconds
+STARTUP_BUDGET = 0.25
+
+# Modules that should only be imported by the commands that need them
+HEAVY_MODULES = [
+    "boto3",
+    "carto2gpd",
+    "esri2gpd",
+    "geopandas",
+    "numpy",
+    "pandas",
+    "phl_courts_scraper_batch",
+    "pydantic",
+    "requests",
+    "s3fs",
+    "selenium",
+    "shapely",
+]
+
+
+def get_commit():
+    """The short hash of the current git commit, if available."""
+
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def sample_points(n, rng, streets=None, city_limits=None):
+    """
+    Sample points inside the city limits, in EPSG:2272.
+
+    If streets are given, points are scattered (with a few feet of noise)
+    along randomly chosen streets, like most shootings; otherwise, they are
+    uniformly distributed. Some points near the border will fall outside
+    the city limits.
+    """
+    if city_limits is None:
+        city_limits = get_city_limits().squeeze().geometry
+    minx, miny, maxx, maxy = city_limits.bounds
+
+    # Along the streets
+    if streets is not None:
+        lines = np.asarray(streets.geometry.array)[
+            rng.integers(0, len(streets), size=n)
+        ]
+        points = shapely.line_interpolate_point(
+            lines, rng.uniform(0, 1, size=n), normalized=True
+        )
+        x, y = get_xy(points)
+        return x + rng.normal(0, 20, size=n), y + rng.normal(0, 20, size=n)
+
+    # Uniform, rejecting points outside the city limits
+    shapely.prepare(city_limits)
+    x, y = np.empty(0), np.empty(0)
+    while len(x) < n:
+        xs = rng.uniform(minx, maxx, size=2 * n)
+        ys = rng.uniform(miny, maxy, size=2 * n)
+        inside = shapely.contains_xy(city_limits, xs, ys)
+        x, y = np.concatenate([x, xs[inside]]), np.concatenate([y, ys[inside]])
+    return x[:n], y[:n]
+
+
+def generate_shootings(n, seed=42, streets=None):
+    """
+    Generate a synthetic page of the raw shooting victims data, as
+    downloaded from Carto.
+
+    Parameters
+    ----------
+    n : int
+        the number of victims
+    seed : int, optional
+        the random seed
+    streets : GeoDataFrame, optional
+        if given, most shootings are located along these streets
+
+    Returns
+    -------
+    GeoDataFrame :
+        the raw data, in EPSG:4326
+    """
+    rng = np.random.default_rng(seed)
+
+    # Locations: mostly on streets, some anywhere in the city, a few missing
+    x, y = sample_points(n, rng)
+    if streets is not None:
+        on_streets = rng.uniform(size=n) < 0.9
+        x[on_streets], y[on_streets] = sample_points(on_streets.sum(), rng, streets)
+    missing = rng.uniform(size=n) < 0.02
+    geometry = np.where(missing, None, shapely.points(x, y))
+    geometry = gpd.GeoSeries(geometry, crs=f"EPSG:{EPSG}").to_crs(epsg=4326)
+    lng, lat = get_xy(geometry)
+
+    # Dates over the last several years
+    dates = pd.Timestamp("2015-01-01") + pd.to_timedelta(
+        rng.integers(0, 8 * 365 * 24 * 3600, size=n), unit="s"
+    )
+    times = pd.Series(dates.strftime("%H:%M:%S")).where(
+        rng.uniform(size=n) > 0.01, "<Null>"
+    )
+
+    # Victim info
+    ages = rng.integers(10, 80, size=n).astype(float)
+    ages[rng.uniform(size=n) < 0.02] = np.nan
+
+    return gpd.GeoDataFrame(
+        {
+            "cartodb_id": np.arange(1, n + 1),
+            "objectid": np.arange(1, n + 1),
+            "year": dates.year.values,
+            "dc_key": dates.year.values * 10**8 + rng.integers(0, 10**8, size=n),
+            "code": rng.choice(["0111", "0411", "0421", "0431"], size=n),
+            "date_": dates.strftime("%Y-%m-%dT00:00:00Z"),
+            "time": times.values,
+            "race": rng.choice(
+                ["B", "W", "A", None], p=[0.8, 0.15, 0.02, 0.03], size=n
+            ),
+            "sex": rng.choice(["M", "F"], p=[0.9, 0.1], size=n),
+            "age": ages,
+            "wound": rng.choice(["Head", "Chest", "Leg", "Multiple"], size=n),
+            "officer_involved": np.where(rng.uniform(size=n) < 0.01, "Y", "N"),
+            "latino": (rng.uniform(size=n) < 0.1).astype(int),
+            "fatal": (rng.uniform(size=n) < 0.2).astype(int),
+            "point_x": lng,
+            "point_y": lat,
+        },
+        geometry=geometry.values,
+        crs="EPSG:4326",
+    )
+
+
+def generate_boundaries(seed=42, city_limits=None):
+    """
+    Generate synthetic boundary layers covering the city, with the same
+    label columns as the layers in `BOUNDARY_FUNCS`.
+
+    Each layer is a Voronoi tessellation of random points, clipped to the
+    city limits.
+
+    Returns
+    -------
+    list of GeoDataFrame :
+        the boundary layers, in EPSG:2272
+    """
+    if city_limits is None:
+        city_limits = get_city_limits().squeeze().geometry
+    rng = np.random.default_rng(seed)
+
+    layers = []
+    for column, size in BOUNDARY_SIZES.items():
+        x, y = sample_points(size, rng, city_limits=city_limits)
+        cells = shapely.get_parts(
+            shapely.voronoi_polygons(shapely.multipoints(shapely.points(x, y)))
+        )
+        cells = shapely.intersection(cells, city_limits)
+        cells = cells[~shapely.is_empty(cells)]
+        layers.append(
+            gpd.GeoDataFrame(
+                {column: [f"{column} {i}" for i in range(len(cells))]},
+                geometry=cells,
+                crs=f"EPSG:{EPSG}",
+            )
+        )
+    return layers
+
+
+@dataclass
+class OfflinePublisher(S3Publisher):
+    """An s3 publisher that compresses the files, but doesn't upload them."""
+
+    def get_remote_hash(self, key):
+        return None
+
+    def upload(self, key, content, content_hash):
+        gzip.compress(content)
+
+
+@contextmanager
+def offline(tmpdir, layers):
+    """
+    Run the pipeline offline: label with the input boundary layers, and
+    save all outputs (and caches) to a temporary directory.
+
+    Parameters
+    ----------
+    tmpdir : Path
+        the directory to save the outputs to
+    layers : list of GeoDataFrame
+        the boundary layers to label shootings with
+    """
+    tmpdir = Path(tmpdir)
+    (tmpdir / "processed").mkdir(parents=True, exist_ok=True)
+
+    # NOTE: the default arguments bind each layer to its own function
+    funcs = [lambda layer=layer: layer for layer in layers]
+
+    patches = [
+        mock.patch.object(shootings, "BOUNDARY_FUNCS", funcs),
+        mock.patch.object(geo, "OVERLAY_PATH", tmpdir / "overlay.fgb"),
+        mock.patch.object(shootings, "INCIDENTS_PATH", tmpdir / "incidents.fgb"),
+        mock.patch.object(shootings, "DATA_DIR", tmpdir),
+        mock.patch.object(shootings, "SNAPSHOT_PATH", tmpdir / "shootings.fgb"),
+        mock.patch.object(shootings, "STATE_PATH", tmpdir / "state.fgb"),
+        mock.patch.object(
+            shootings,
+            "S3Publisher",
+            partial(OfflinePublisher, manifest_path=tmpdir / "s3_manifest.json"),
+        ),
+        mock.patch.object(
+            StreetHotSpots, "assignments_path", tmpdir / "segment_assignments.csv"
+        ),
+    ]
+    with ExitStack() as stack:
+        for patch in patches:
+            stack.enter_context(patch)
+        yield
+
+
+def save_incident_fixtures(raw, path, seed=42, city_limits=None):
+    """Save incident lookups for the shootings with missing locations (or
+    outside the city limits), so they are found without querying Carto;
+    about half have a location."""
+
+    if city_limits is None:
+        city_limits = get_city_limits().squeeze().geometry
+    rng = np.random.default_rng(seed)
+
+    x, y = get_xy(raw.geometry.to_crs(epsg=EPSG))
+    missing = ~shapely.contains_xy(city_limits, x, y)
+    dc_keys = pd.unique(raw.loc[missing, "dc_key"].astype(str))
+
+    x, y = sample_points(len(dc_keys), rng)
+    found = rng.uniform(size=len(dc_keys)) < 0.5
+    geometry = np.where(found, shapely.points(x, y), None)
+
+    incidents = gpd.GeoDataFrame(
+        {"dc_key": dc_keys, "looked_up_at": time.time()},
+        geometry=gpd.GeoSeries(geometry, crs=f"EPSG:{EPSG}").to_crs(epsg=4326),
+    )
+    geo.save_fgb(incidents, path)
+
+
+def timeit(func, setup=None, repeat=3):
+    """Time a function, returning the time of each run; the optional setup
+    function is called before each run (outside the timing), and its
+    result is passed to the function."""
+
+    times = []
+    for _ in range(repeat):
+        args = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+@dataclass
+class BenchmarkSuite:
+    """
+    Time the hot paths of the daily update on synthetic data, without any
+    network access.
+
+    The shootings are generated inside the city limits, mostly along the
+    real street network, and labeled with synthetic boundary layers. Each
+    benchmark is run ``repeat`` times for each number of rows in
+    ``sizes``.
+    """
+
+    sizes: list = field(default_factory=lambda: [10000, 100000])
+    repeat: int = 3
+    seed: int = 42
+
+    def run_size(self, n, streets, city_limits, tmpdir):
+        """Run the benchmarks for ``n`` rows, returning the times."""
+
+        victims = shootings.ShootingVictimsData(ignore_checks=True)
+        raw = generate_shootings(n, seed=self.seed, streets=streets)
+        save_incident_fixtures(
+            raw, tmpdir / "incidents.fgb", seed=self.seed, city_limits=city_limits
+        )
+        times = {}
+
+        # Normalize the raw data
+        times["format"] = timeit(lambda: victims.format(raw), repeat=self.repeat)
+
+        # Locations as x/y, like the pipeline
+        df = victims.format(raw)
+        df["x"], df["y"] = get_xy(df.geometry)
+        df = pd.DataFrame(df.drop(columns=["geometry"]))
+
+        # Geographic info
+        times["add_geographic_info"] = timeit(
+            shootings.add_geographic_info, setup=df.copy, repeat=self.repeat
+        )
+        df = shootings.add_geographic_info(df)
+
+        # Hot spots, matching every point to the streets
+        def _fresh_copy():
+            (tmpdir / "segment_assignments.csv").unlink(missing_ok=True)
+            return df.copy()
+
+        hotspots = StreetHotSpots()
+        times["StreetHotSpots.merge"] = timeit(
+            hotspots.merge, setup=_fresh_copy, repeat=self.repeat
+        )
+
+        # Hot spots, with all points in the saved assignments
+        times["StreetHotSpots.merge (saved)"] = timeit(
+            hotspots.merge, setup=df.copy, repeat=self.repeat
+        )
+        df = hotspots.merge(df)
+        df["row_hash"] = shootings.hash_rows(df)
+
+        # Court info
+        times["courts.merge"] = timeit(
+            merge_court_info, setup=df.copy, repeat=self.repeat
+        )
+
+        # The output format
+        data = victims.finalize(df.copy())
+        fields = shootings.ShootingVictimsSchema.__fields__.keys()
+        data = data[fields]
+
+        # Validation
+        times["validate_data_schema"] = timeit(
+            lambda: validate_columns(
+                data,
+                shootings.ShootingVictimsSchema,
+                {"dc_key": shootings.verify_dc_key_column},
+            ),
+            repeat=self.repeat,
+        )
+
+        # Saving the annual files, the snapshot and the state
+        times["save"] = timeit(
+            lambda: victims.publish(victims.save(data)), repeat=self.repeat
+        )
+
+        return times
+
+    def run(self):
+        """Run all benchmarks, returning the results as a dict."""
+
+        streets = StreetHotSpots().block_level_streets
+        city_limits = get_city_limits().squeeze().geometry
+        layers = generate_boundaries(seed=self.seed, city_limits=city_limits)
+
+        results = {}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            with offline(tmpdir, layers):
+
+                # Build the boundary overlay once, like the daily update
+                geo.get_boundary_overlay(layers)
+
+                for n in self.sizes:
+                    logger.info(f"Running benchmarks for {n} rows")
+                    times = self.run_size(n, streets, city_limits, tmpdir)
+                    for name, times in times.items():
+                        results[f"{name}[{n}]"] = dict(
+                            name=name, rows=n, times=times, best=min(times)
+                        )
+                        logger.info(f"  {name}: {min(times):.3f}s")
+
+        return dict(
+            commit=get_commit(),
+            created_at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            python=platform.python_version(),
+            platform=platform.platform(),
+            versions={lib.__name__: lib.__version__ for lib in [np, pd, gpd, shapely]},
+            repeat=self.repeat,
+            seed=self.seed,
+            results=results,
+        )
+
+
+def save_results(results, path):
+    """Save benchmark results as JSON."""
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    json.dump(results, path.open(mode="w"), indent=2)
+
+
+def load_results(path):
+    """Load benchmark results saved as JSON."""
+
+    return json.load(Path(path).open(mode="r"))
+
+
+def compare_results(old, new, threshold=0.1):
+    """
+    Compare the best times of two benchmark runs.
+
+    Parameters
+    ----------
+    old, new : dict
+        the benchmark results to compare
+    threshold : float, optional
+        the relative increase in time that counts as a slowdown
+
+    Returns
+    -------
+    DataFrame :
+        the old and new times of the benchmarks in both runs, the ratio of
+        new to old, and whether it is a slowdown
+    """
+    keys = [key for key in new["results"] if key in old["results"]]
+    out = pd.DataFrame(
+        {
+            "benchmark": keys,
+            "old": [old["results"][key]["best"] for key in keys],
+            "new": [new["results"][key]["best"] for key in keys],
+        }
+    )
+    out["ratio"] = out["new"] / out["old"]
+    out["slowdown"] = out["ratio"] > 1 + threshold
+    return out
+
+
+def parse_importtime(output):
+    """
+    Parse the output of ``python -X importtime``.
+
+    Returns
+    -------
+    DataFrame :
+        the self and cumulative import time of each module (in seconds),
+        and its depth in the import tree (0 for top-level imports)
+    """
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        rows.append(
+            dict(
+                module=name.strip(),
+                self=int(self_us) / 1e6,
+                cumulative=int(cumulative_us) / 1e6,
+                depth=(len(name) - len(name.lstrip()) - 1) // 2,
+            )
+        )
+    return pd.DataFrame(rows, columns=["module", "self", "cumulative", "depth"])
+
+
+def time_startup(args=("--help",), repeat=5):
+    """
+    Time the imports needed to run the CLI with the input arguments, using
+    ``python -X importtime`` in a fresh interpreter.
+
+    Returns
+    -------
+    DataFrame :
+        the imports of the fastest run (see `parse_importtime`)
+    """
+    runs = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-m", __package__, *args],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        runs.append(parse_importtime(result.stderr))
+    return min(runs, key=lambda imports: imports["self"].sum())
+
+
+def check_startup(imports, budget=STARTUP_BUDGET):
+    """
+    Check the imports of a CLI run against the startup budget.
+
+    Returns
+    -------
+    list of str :
+        the problems found: the total import time is over budget, or
+        heavy modules were imported
+    """
+    problems = []
+
+    total = imports["self"].sum()
+    if total > budget:
+        problems.append(f"Imports took {total:.3f}s, over the {budget:.3f}s budget")
+
+    modules = set(imports["module"])
+    heavy = [name for name in HEAVY_MODULES if name in modules]
+    if heavy:
+        problems.append(f"Heavy modules were imported: {', '.join(heavy)}")
+
+    return problems
@@ -0,0 +1,130 @@
+"""Query the City of Philadelphia's Carto SQL API."""
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import geopandas as gpd
+import pandas as pd
+from cached_property import cached_property
+
+from .sessions import get_session
+
+
+def _quote(value):
+    """Quote a value for use in a SQL query."""
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _empty_frame(columns):
+    """An empty frame with the given columns, for queries without results."""
+    return gpd.GeoDataFrame(
+        {col: pd.Series(dtype=object) for col in columns if col != "the_geom"},
+        geometry=gpd.GeoSeries(crs="EPSG:4326"),
+    )
+
+
+@dataclass
+class CartoClient:
+    """Client for the Carto SQL API that reuses connections, retries
+    failed requests with backoff, and splits large lookups into batches
+    that run concurrently."""
+
+    endpoint: str = "https://phl.carto.com/api/v2/sql"
+    batch_size: int = 500
+    max_workers: int = 4
+    retries: int = 3
+    backoff_factor: float = 0.5
+    timeout: float = 60
+
+    @cached_property
+    def session(self):
+        """A pooled session that retries failed requests."""
+        return get_session(
+            retries=self.retries,
+            backoff_factor=self.backoff_factor,
+            pool_maxsize=self.max_workers,
+            allowed_methods=["GET", "POST"],  # These are all read-only queries
+        )
+
+    def query(self, query, format="json"):
+        """Run a SQL query and return the JSON response."""
+
+        params = dict(q=query, format=format)
+        r = self.session.post(self.endpoint, data=params, timeout=self.timeout)
+        if r.status_code != 200:
+            raise ValueError(f"Error querying carto API: {r.text}")
+
+        json = r.json()
+        if "error" in json:
+            raise ValueError(json["error"][0])
+        return json
+
+    def get(self, table_name, where=None, fields=None, order_by=None, limit=None):
+        """Query a table and return the features as a GeoDataFrame."""
+
+        # Get the fields
+        columns = [] if fields is None else [f for f in fields if f != "the_geom"]
+        select = ",".join(columns + ["the_geom"]) if fields is not None else "*"
+
+        # Build the query
+        query = f"SELECT {select} FROM {table_name}"
+        if where:
+            query += f" WHERE {where}"
+        if order_by:
+            query += f" ORDER BY {order_by}"
+        if limit:
+            query += f" LIMIT {limit}"
+
+        features = self.query(query, format="geojson")
+        if not features["features"]:
+            return _empty_frame(columns)
+        return gpd.GeoDataFrame.from_features(features, crs="EPSG:4326")
+
+    def get_by_key(self, table_name, key, values, fields=None):
+        """Query the features in a table whose key is in the input values.
+
+        The values are split into batches of ``batch_size`` which are
+        queried concurrently, and the results combined into one frame.
+        """
+        values = list(dict.fromkeys(values))
+        batches = [
+            values[i : i + self.batch_size]
+            for i in range(0, len(values), self.batch_size)
+        ]
+
+        def _get_batch(batch):
+            where = f"{key} IN ( {', '.join(_quote(v) for v in batch)} )"
+            return self.get(table_name, where=where, fields=fields)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            frames = list(pool.map(_get_batch, batches))
+
+        if not frames:
+            return _empty_frame([] if fields is None else fields)
+        return gpd.GeoDataFrame(
+            pd.concat(frames, ignore_index=True), geometry="geometry", crs="EPSG:4326"
+        )
+
+    def iter_pages(self, table_name, key="cartodb_id", page_size=10000, fields=None):
+        """Yield all features in a table as GeoDataFrames of at most
+        ``page_size`` rows.
+
+        Pages are fetched with keyset pagination on ``key``, which must be a
+        unique, numeric column, so only one page is in memory at a time.
+        """
+        if fields is not None and key not in fields:
+            fields = [key] + list(fields)
+
+        last = None
+        while True:
+            where = None if last is None else f"{key} > {last}"
+            page = self.get(
+                table_name, where=where, fields=fields, order_by=key, limit=page_size
+            )
+            if not len(page):
+                break
+            yield page
+
+            if len(page) < page_size:
+                break
+            last = page[key].max()
@@ -7,8 +7,6 @@ import pandas as pd
 import simplejson as json
 from dotenv import find_dotenv, load_dotenv
 from loguru import logger
-from phl_courts_scraper_batch.__main__ import scrape
-from s3fs import S3FileSystem
 
 from . import BUCKET_NAME, DATA_DIR
 
@@ -28,6 +26,10 @@ def run(
 ):
     """Run the courts scraper."""
 
+    # NOTE: the scraper is only needed here, not to merge its results
+    from phl_courts_scraper_batch.__main__ import scrape
+    from s3fs import S3FileSystem
+
     # Load the environment variables
     load_dotenv(find_dotenv())
 
@@ -113,7 +115,7 @@ def run(
 
     # Combine the results!
     output = output.merge(dc_numbers_with_cases, on="dc_key", how="left").assign(
-        has_court_case=lambda df: df.has_court_case.fillna(False)
+        has_court_case=lambda df: df.has_court_case.eq(True)
     )
 
     # Update the saved data
@@ -124,7 +126,7 @@ def run(
 
 
 def merge(data, debug=False):
-    """Merge courts data."""
+    """Merge courts data into the input data, in place."""
 
     # Load existing data
     existing = pd.read_csv(DATA_PATH, dtype={"dc_key": str})
@@ -132,10 +134,10 @@ def merge(data, debug=False):
     if debug:
         logger.debug("Merging in court case information")
 
-    # Make a copy
-    out = data.copy()
+    # Look up each incident and fill missing ones with False
+    has_court_case = existing.drop_duplicates(subset="dc_key").set_index("dc_key")[
+        "has_court_case"
+    ]
+    data["has_court_case"] = data["dc_key"].map(has_court_case).eq(True)
 
-    # Return the merge and fill missing ones with False
-    return out.merge(existing, on="dc_key", how="left").assign(
-        has_court_case=lambda df: df["has_court_case"].fillna(False)
-    )
+    return data
@@ -1,15 +1,281 @@
 """Load various geographic boundaries in Philadelphia."""
 
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
 import esri2gpd
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+import requests
+import shapely
+import simplejson as json
+from loguru import logger
 
-from . import DATA_DIR, EPSG
+from . import CACHE_DIR, DATA_DIR, EPSG
+from .profiling import REPORT
 
 
 def number_to_string(value):
     return str(int(value))
 
 
+def save_fgb(df, path):
+    """Save a GeoDataFrame as a FlatGeobuf file."""
+
+    # NOTE: without a spatial index, the features keep their order and
+    # null geometries can be stored
+    df.to_file(path, driver="FlatGeobuf", SPATIAL_INDEX="NO")
+
+
+@dataclass
+class BoundaryCache:
+    """On-disk cache for boundary layers downloaded from ArcGIS FeatureServers.
+
+    Layers are cached already projected to EPSG:2272, keyed by the service
+    URL and list of fields. A cached layer is reused if the FeatureServer's
+    ``editingInfo.lastEditDate`` hasn't changed; if the service doesn't
+    report an edit date (or can't be reached), the cached layer is reused
+    until it is older than ``ttl`` seconds. In offline mode, only cached
+    layers are used.
+
+    Each layer is only loaded (and revalidated) once per process, so the
+    layers can be loaded concurrently in the background and reused later.
+    """
+
+    ttl: float = float(os.environ.get("GV_DASHBOARD_BOUNDARY_TTL", 7 * 24 * 3600))
+    offline: bool = os.environ.get("GV_DASHBOARD_OFFLINE", "") not in ("", "0")
+    path: Path = CACHE_DIR / "geo"
+    timeout: float = 30
+
+    def __post_init__(self):
+        self._layers = {}
+        self._edit_dates = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _key(self, url, fields):
+        """The cache key for a layer."""
+        key = url.rstrip("/") + "?fields=" + ",".join(fields)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+    def _get_last_edit_date(self, url):
+        """The last edit date reported by the FeatureServer, if any."""
+        r = requests.get(url, params=dict(f="json"), timeout=self.timeout)
+        r.raise_for_status()
+        return r.json().get("editingInfo", {}).get("lastEditDate")
+
+    def get_last_edit_date(self, url):
+        """The last edit date reported by the FeatureServer, requested only
+        once per process; None if it isn't reported or can't be requested."""
+
+        if url not in self._edit_dates:
+            # NOTE: failures fall back to the TTL, and don't block a download
+            try:
+                self._edit_dates[url] = self._get_last_edit_date(url)
+            except (requests.RequestException, ValueError) as e:
+                logger.warning(f"Unable to get the last edit date for {url}: {e}")
+                self._edit_dates[url] = None
+        return self._edit_dates[url]
+
+    def get_version(self, url, fields):
+        """A cheap version stamp of a layer, without loading it.
+
+        This is the FeatureServer's last edit date, or, if that isn't
+        available (or in offline mode), the time the cached layer was fetched.
+        """
+        if not self.offline:
+            last_edit_date = self.get_last_edit_date(url)
+            if last_edit_date is not None:
+                return last_edit_date
+
+        meta_path = self.path / f"{self._key(url, fields)}.json"
+        if meta_path.exists():
+            return json.load(meta_path.open(mode="r"))["fetched_at"]
+        return None
+
+    def get(self, url, fields):
+        """Load the layer, from the cache if it is still valid."""
+
+        key = self._key(url, fields)
+
+        # NOTE: concurrent loads of the same layer wait for the first one
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._layers:
+                self._layers[key] = self._load(url, fields, key)
+        return self._layers[key].copy()
+
+    def _load(self, url, fields, key):
+        """Load the layer from the cache or the FeatureServer."""
+
+        data_path = self.path / f"{key}.fgb"
+        meta_path = self.path / f"{key}.json"
+
+        # Load cached info
+        meta = None
+        if data_path.exists() and meta_path.exists():
+            meta = json.load(meta_path.open(mode="r"))
+
+        # Offline mode: cache only
+        if self.offline:
+            if meta is None:
+                raise ValueError(f"No cached boundaries available offline for {url}")
+            return gpd.read_file(data_path)
+
+        # Get the last edit date
+        last_edit_date = self.get_last_edit_date(url)
+
+        # Revalidate
+        if meta is not None:
+            if last_edit_date is not None:
+                valid = last_edit_date == meta["last_edit_date"]
+            else:
+                valid = time.time() - meta["fetched_at"] < self.ttl
+
+            if valid:
+                return gpd.read_file(data_path)
+
+        # Download a fresh copy
+        logger.debug(f"Downloading boundaries from {url}")
+        out = esri2gpd.get(url, fields=list(fields)).to_crs(epsg=EPSG)
+
+        # Save to the cache
+        self.path.mkdir(parents=True, exist_ok=True)
+        save_fgb(out, data_path)
+        json.dump(
+            dict(
+                url=url,
+                fields=list(fields),
+                last_edit_date=last_edit_date,
+                fetched_at=time.time(),
+            ),
+            meta_path.open(mode="w"),
+        )
+
+        return out
+
+
+# The shared boundary cache
+BOUNDARY_CACHE = BoundaryCache()
+
+
+def get_xy(geometry):
+    """Return the x/y coordinates of the input point geometries as float
+    arrays, with NaN for missing or empty points."""
+
+    geometry = np.asarray(geometry)
+    valid = ~(shapely.is_missing(geometry) | shapely.is_empty(geometry))
+
+    x = np.full(len(geometry), np.nan)
+    y = np.full(len(geometry), np.nan)
+    x[valid] = shapely.get_x(geometry[valid])
+    y[valid] = shapely.get_y(geometry[valid])
+    return x, y
+
+
+def has_xy(x, y):
+    """Return a mask of the valid (non-NaN) x/y coordinates."""
+
+    return ~(np.isnan(x) | np.isnan(y))
+
+
+def xy_to_points(x, y):
+    """Return point geometries for the input x/y coordinates; invalid
+    coordinates become empty points."""
+
+    valid = has_xy(x, y)
+    points = np.full(len(x), shapely.Point(), dtype=object)
+    points[valid] = shapely.points(x[valid], y[valid])
+    return points
+
+
+def get_boundaries(url, fields):
+    """Load a boundary layer in EPSG:2272, using the shared cache."""
+
+    return BOUNDARY_CACHE.get(url, fields)
+
+
+@dataclass
+class BoundaryLabeler:
+    """Label points with the boundaries they fall within, for several
+    boundary layers at once.
+
+    A single spatial index is built over the points, and each layer's
+    (prepared) boundaries are queried against it in bulk. If a point falls
+    within multiple boundaries of the same layer, the first boundary (in
+    layer order) wins. Each layer's non-geometry columns are added as labels.
+    """
+
+    layers: list
+
+    def __post_init__(self):
+        self.boundaries = []
+        for layer in self.layers:
+            geoms = np.asarray(layer.geometry.array)
+            shapely.prepare(geoms)
+            self.boundaries.append(geoms)
+        self.timings = {}
+
+    def label(self, geometry):
+        """Return a dict of label column name to array of labels for the
+        input point geometries; points outside a layer get NaN."""
+
+        points = np.asarray(geometry)
+        tree = shapely.STRtree(points)
+
+        out = {}
+        for layer, boundaries in zip(self.layers, self.boundaries):
+            start = time.perf_counter()
+            columns = [col for col in layer.columns if col != layer.geometry.name]
+            name = ", ".join(columns)
+
+            with REPORT.stage(f"geo:{name}") as stage:
+                # Find all (boundary, point) pairs
+                boundary_idx, point_idx = tree.query(boundaries, predicate="contains")
+
+                # Keep the first boundary for each point
+                order = np.lexsort((boundary_idx, point_idx))
+                point_idx, boundary_idx = point_idx[order], boundary_idx[order]
+                first = np.ones(len(point_idx), dtype=bool)
+                first[1:] = point_idx[1:] != point_idx[:-1]
+                point_idx, boundary_idx = point_idx[first], boundary_idx[first]
+
+                # Fill in the labels
+                for col in columns:
+                    values = np.full(len(points), np.nan, dtype=object)
+                    values[point_idx] = layer[col].values[boundary_idx]
+                    out[col] = values
+
+                stage.count(rows_in=len(points), rows_out=len(point_idx))
+
+            # Log the timing
+            self.timings[name] = time.perf_counter() - start
+            logger.debug(
+                f"Labeled {len(points)} points by {name} in {self.timings[name]:.3f}s"
+            )
+
+        return out
+
+
+# The FeatureServer of each boundary layer, by its label column
+BOUNDARY_URLS = {
+    "house_district": "https://services.arcgis.com/fLeGjb7u4uXqeF9q/arcgis/rest/services/Gun_Violence_Dashboard_PA_House_Districts/FeatureServer/0",
+    "senate_district": "https://services.arcgis.com/fLeGjb7u4uXqeF9q/arcgis/rest/services/Gun_Violence_Dashboard_PA_Senate_Districts/FeatureServer/0",
+    "school_name": "https://services.arcgis.com/fLeGjb7u4uXqeF9q/arcgis/rest/services/Gun_Violence_Dashboard_School_Catchments/FeatureServer/0",
+    "police_district": "https://services.arcgis.com/fLeGjb7u4uXqeF9q/arcgis/rest/services/Gun_Violence_Dashboard_Police_Districts/FeatureServer/0",
+    "zip_code": "https://services.arcgis.com/fLeGjb7u4uXqeF9q/arcgis/rest/services/Gun_Violence_Dashboard_ZIP_Codes/FeatureServer/0",
+    "council_district": "https://services.arcgis.com/fLeGjb7u4uXqeF9q/arcgis/rest/services/Gun_Violence_Dashboard_Council_Districts/FeatureServer/0/",
+    "neighborhood": "https://services.arcgis.com/fLeGjb7u4uXqeF9q/arcgis/rest/services/Gun_Violence_Dashboard_Neighborhoods/FeatureServer/0",
+}
+
+
 def get_city_limits():
     """Load the city limits."""
 
@@ -20,81 +286,138 @@ def get_city_limits():
 def get_pa_house_districts():
     """PA House districts in in Philadelphia."""
 
-    return (
-        esri2gpd.get(
-            "https://services.arcgis.com/fLeGjb7u4uXqeF9q/arcgis/rest/services/Gun_Violence_Dashboard_PA_House_Districts/FeatureServer/0",
-            fields=["house_district"],
-        )
-        .assign(house_district=lambda df: df.house_district.apply(number_to_string))
-        .to_crs(epsg=EPSG)
-    )
+    return get_boundaries(
+        BOUNDARY_URLS["house_district"], fields=["house_district"]
+    ).assign(house_district=lambda df: df.house_district.apply(number_to_string))
 
 
 def get_pa_senate_districts():
     """PA Senate districts in in Philadelphia."""
 
-    return (
-        esri2gpd.get(
-            "https://services.arcgis.com/fLeGjb7u4uXqeF9q/arcgis/rest/services/Gun_Violence_Dashboard_PA_Senate_Districts/FeatureServer/0",
-            fields=["senate_district"],
-        )
-        .assign(senate_district=lambda df: df.senate_district.apply(number_to_string))
-        .to_crs(epsg=EPSG)
-    )
+    return get_boundaries(
+        BOUNDARY_URLS["senate_district"], fields=["senate_district"]
+    ).assign(senate_district=lambda df: df.senate_district.apply(number_to_string))
 
 
 def get_school_catchments():
     """Elementary school catchments in in Philadelphia."""
 
-    return esri2gpd.get(
-        "https://services.arcgis.com/fLeGjb7u4uXqeF9q/arcgis/rest/services/Gun_Violence_Dashboard_School_Catchments/FeatureServer/0",
-        fields=["school_name"],
-    ).to_crs(epsg=EPSG)
+    return get_boundaries(BOUNDARY_URLS["school_name"], fields=["school_name"])
 
 
 def get_police_districts():
     """Police Districts in Philadelphia."""
 
-    return (
-        esri2gpd.get(
-            "https://services.arcgis.com/fLeGjb7u4uXqeF9q/arcgis/rest/services/Gun_Violence_Dashboard_Police_Districts/FeatureServer/0",
-            fields=["police_district"],
-        )
-        .to_crs(epsg=EPSG)
-        .assign(police_district=lambda df: df.police_district.apply(number_to_string))
-    )
+    return get_boundaries(
+        BOUNDARY_URLS["police_district"], fields=["police_district"]
+    ).assign(police_district=lambda df: df.police_district.apply(number_to_string))
 
 
 def get_zip_codes():
     """ZIP Codes in Philadelphia."""
 
-    return (
-        esri2gpd.get(
-            "https://services.arcgis.com/fLeGjb7u4uXqeF9q/arcgis/rest/services/Gun_Violence_Dashboard_ZIP_Codes/FeatureServer/0",
-            fields=["zip_code"],
-        )
-        .to_crs(epsg=EPSG)
-        .assign(zip_code=lambda df: df.zip_code.apply(number_to_string))
+    return get_boundaries(BOUNDARY_URLS["zip_code"], fields=["zip_code"]).assign(
+        zip_code=lambda df: df.zip_code.apply(number_to_string)
     )
 
 
 def get_council_districts():
     """Council Districts in Philadelphia."""
 
-    return (
-        esri2gpd.get(
-            "https://services.arcgis.com/fLeGjb7u4uXqeF9q/arcgis/rest/services/Gun_Violence_Dashboard_Council_Districts/FeatureServer/0/",
-            fields=["council_district"],
-        )
-        .assign(council_district=lambda df: df.council_district.apply(number_to_string))
-        .to_crs(epsg=EPSG)
-    )
+    return get_boundaries(
+        BOUNDARY_URLS["council_district"], fields=["council_district"]
+    ).assign(council_district=lambda df: df.council_district.apply(number_to_string))
 
 
 def get_neighborhoods():
     """Neighborhoods in Philadelphia."""
 
-    return esri2gpd.get(
-        "https://services.arcgis.com/fLeGjb7u4uXqeF9q/arcgis/rest/services/Gun_Violence_Dashboard_Neighborhoods/FeatureServer/0",
-        fields=["neighborhood"],
-    ).to_crs(epsg=EPSG)
+    return get_boundaries(BOUNDARY_URLS["neighborhood"], fields=["neighborhood"])
+
+
+# The boundary layers used to label shootings
+BOUNDARY_FUNCS = [
+    get_zip_codes,
+    get_police_districts,
+    get_council_districts,
+    get_neighborhoods,
+    get_school_catchments,
+    get_pa_house_districts,
+    get_pa_senate_districts,
+]
+
+
+def get_boundary_versions():
+    """Cheap version stamps of the boundary layers, without loading them."""
+
+    # NOTE: the FeatureServers are requested concurrently
+    with ThreadPoolExecutor(max_workers=len(BOUNDARY_URLS)) as pool:
+        versions = pool.map(
+            lambda item: BOUNDARY_CACHE.get_version(item[1], [item[0]]),
+            BOUNDARY_URLS.items(),
+        )
+        return dict(zip(BOUNDARY_URLS, versions))
+
+
+# Where the overlay of all boundary layers is saved
+OVERLAY_PATH = CACHE_DIR / "geo" / "overlay.fgb"
+
+
+def fingerprint_layers(layers):
+    """A hash of the labels and geometries of the input layers."""
+
+    h = hashlib.sha1()
+    for layer in layers:
+        labels = layer.drop(columns=[layer.geometry.name])
+        h.update(pd.util.hash_pandas_object(labels, index=False).values.tobytes())
+        h.update(b"".join(shapely.to_wkb(np.asarray(layer.geometry.array))))
+    return h.hexdigest()
+
+
+def build_boundary_overlay(layers):
+    """Intersect the boundary layers into a single layer of "atomic units",
+    each carrying the labels from every layer.
+
+    The boundaries of all layers are noded together and polygonized into
+    faces, and each face is labeled by a point on its surface, so overlaps
+    within a layer are resolved the same way as `BoundaryLabeler`.
+    """
+    lines = shapely.boundary(
+        np.concatenate([np.asarray(layer.geometry.array) for layer in layers])
+    )
+    noded = shapely.union_all(lines)
+    faces = shapely.get_parts(shapely.polygonize(shapely.get_parts(noded)))
+
+    # Label each face
+    crs = layers[0].crs
+    points = gpd.GeoSeries(shapely.point_on_surface(faces), crs=crs)
+    labels = BoundaryLabeler(layers).label(points)
+
+    # Remove faces outside of every layer, i.e., holes
+    out = gpd.GeoDataFrame(labels, geometry=faces, crs=crs)
+    return out.dropna(how="all", subset=list(labels)).reset_index(drop=True)
+
+
+def get_boundary_overlay(layers=None, rebuild=False):
+    """Load the overlay of all boundary layers, rebuilding it only if
+    one of the input layers has changed."""
+
+    if layers is None:
+        layers = [func() for func in BOUNDARY_FUNCS]
+
+    # Check the saved overlay
+    fingerprint = fingerprint_layers(layers)
+    meta_path = OVERLAY_PATH.with_suffix(".json")
+    if not rebuild and OVERLAY_PATH.exists() and meta_path.exists():
+        meta = json.load(meta_path.open(mode="r"))
+        if meta["fingerprint"] == fingerprint:
+            return gpd.read_file(OVERLAY_PATH)
+
+    # Build and save
+    logger.info("Building overlay of boundary layers")
+    overlay = build_boundary_overlay(layers)
+    OVERLAY_PATH.parent.mkdir(parents=True, exist_ok=True)
+    save_fgb(overlay, OVERLAY_PATH)
+    json.dump(dict(fingerprint=fingerprint), meta_path.open(mode="w"))
+
+    return overlay
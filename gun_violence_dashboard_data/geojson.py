@@ -0,0 +1,167 @@
+"""Fast GeoJSON serialization of point data.
+
+The output is byte-for-byte identical to writing the data with
+``to_file(..., driver="GeoJSON")``, which goes through GDAL one feature at a
+time, but is built directly from the columns and coordinate arrays.
+"""
+
+from json.encoder import encode_basestring
+
+import numpy as np
+import pandas as pd
+import shapely
+
+# The header and footer written by GDAL, for data in EPSG:4326
+HEADER = (
+    '{{\n"type": "FeatureCollection",\n"name": "{name}",\n'
+    '"crs": {{ "type": "name", "properties": '
+    '{{ "name": "urn:ogc:def:crs:OGC:1.3:CRS84" }} }},\n"features": [\n'
+)
+FOOTER = "\n]\n}\n"
+
+
+def _roundup(s):
+    """Round up the last digit of a number formatted in fixed-point."""
+
+    sign = "-" if s[0] == "-" else ""
+    digits = s.lstrip("-")
+    decimals = len(digits) - digits.find(".") - 1
+    digits = digits.replace(".", "")
+    digits = str(int(digits) + 1).zfill(len(digits))
+    return sign + digits[:-decimals] + "." + digits[-decimals:]
+
+
+def format_coordinate(value):
+    """
+    Format a coordinate the way GDAL does: fixed-point with 15 decimals,
+    rounding away trailing 0000x and 9999x sequences (which are likely
+    round-off errors) and trimming trailing zeros.
+
+    Parameters
+    ----------
+    value : float
+        the coordinate value
+
+    Returns
+    -------
+    str :
+        the formatted coordinate
+    """
+    s = "%.15f" % value
+    n = len(s)
+
+    # The number of trailing digits to check for the 8-digit patterns
+    # depends on the number of digits before the decimal point, less one
+    before = s.find(".") - 1 - (1 if s[0] == "-" else 0)
+    end = n - min(max(3, before), 8) + 1
+
+    # Trailing 00000x
+    if s[n - 6 : n - 1] == "00000":
+        s = s[:-1]
+    elif not s[n - 9 : end].strip("0"):
+        s = s[: n - 8] + "0" * 8
+
+    # Trailing 99999x
+    elif s[n - 6 : n - 1] == "99999":
+        s = _roundup(s[: n - 6])
+    elif not s[n - 9 : end].strip("9"):
+        s = _roundup(s[: n - 9])
+
+    s = s.rstrip("0")
+    return s + "0" if s.endswith(".") else s
+
+
+def format_real(value):
+    """
+    Format a real-valued property the way GDAL does: 17 significant digits,
+    falling back to up to 3 fewer digits to avoid 999999 or 000000 round-off
+    sequences, and always including a decimal point or exponent.
+
+    Parameters
+    ----------
+    value : float
+        the property value
+
+    Returns
+    -------
+    str :
+        the formatted value
+    """
+    s = "%.17g" % value
+    dot = s.find(".")
+    if dot >= 0 and ("999999" in s[dot:] or "000000" in s[dot:]):
+        for precision in (16, 15, 14):
+            t = "%.*g" % (precision, value)
+            dot = t.find(".")
+            if dot >= 0 and "999999" not in t[dot:] and "000000" not in t[dot:]:
+                s = t
+                break
+
+    if "." not in s and "e" not in s:
+        s += ".0"
+    return s
+
+
+def _format_values(values):
+    """Format a column of property values as JSON."""
+
+    null = pd.isnull(values).values
+    out = np.full(len(values), f'"{values.name}": null', dtype=object)
+
+    # Format each unique value once
+    if pd.api.types.is_bool_dtype(values):
+        formatter = lambda v: "true" if v else "false"
+    elif pd.api.types.is_integer_dtype(values):
+        formatter = str
+    elif pd.api.types.is_float_dtype(values):
+        formatter = format_real
+    else:
+        formatter = lambda v: encode_basestring(str(v))
+
+    codes, uniques = pd.factorize(values[~null])
+    formatted = np.array(
+        [f'"{values.name}": {formatter(v)}' for v in uniques] + [""], dtype=object
+    )
+    out[~null] = formatted[codes]
+    return out
+
+
+def to_geojson(df, name):
+    """
+    Serialize a GeoDataFrame of points in EPSG:4326 to GeoJSON.
+
+    Parameters
+    ----------
+    df : geopandas.GeoDataFrame
+        the data to serialize; missing or empty points are written with
+        null geometries
+    name : str
+        the name of the feature collection, i.e., the file name without
+        the extension
+
+    Returns
+    -------
+    bytes :
+        the UTF-8 encoded GeoJSON
+    """
+    # Properties, in column order
+    columns = [col for col in df.columns if col != df.geometry.name]
+    properties = [_format_values(df[col]) for col in columns]
+
+    # Geometries
+    geometry = df.geometry.values
+    null = (shapely.is_missing(geometry) | shapely.is_empty(geometry)).astype(bool)
+    coords = shapely.get_coordinates(geometry[~null])
+    geometries = np.full(len(df), "null", dtype=object)
+    geometries[~null] = [
+        f'{{ "type": "Point", "coordinates": [ {format_coordinate(x)}, '
+        f"{format_coordinate(y)} ] }}"
+        for x, y in coords
+    ]
+
+    features = [
+        f'{{ "type": "Feature", "properties": {{ {", ".join(props)} }}, '
+        f'"geometry": {geom} }}'
+        for props, geom in zip(zip(*properties), geometries)
+    ]
+    return (HEADER.format(name=name) + ",\n".join(features) + FOOTER).encode("utf-8")
@@ -6,11 +6,6 @@ Crime Stats website.
 from dataclasses import dataclass
 from datetime import date
 
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.common.by import By
-from selenium.common.exceptions import TimeoutException
-from selenium.webdriver.support import expected_conditions as EC
-from selenium import webdriver
 import requests
 import pandas as pd
 from bs4 import BeautifulSoup
@@ -18,6 +13,14 @@ from cached_property import cached_property
 from loguru import logger
 
 from . import DATA_DIR
+from .recording import HTTP_RECORDER
+from .sessions import get_session
+
+# Browsers are sometimes served a different page than HTTP clients
+USER_AGENT = (
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+)
 
 
 def get_webdriver(debug=False):
@@ -29,6 +32,9 @@ def get_webdriver(debug=False):
     debug: bool
         Whether to use the headless version of Chrome
     """
+    # NOTE: selenium is only needed if the page can't be fetched directly
+    from selenium import webdriver
+
     # Create the options
     options = webdriver.ChromeOptions()
     options.add_argument("--no-sandbox")
@@ -40,6 +46,24 @@ def get_webdriver(debug=False):
     return webdriver.Chrome(options=options)
 
 
+def has_homicide_totals(soup):
+    """Whether the parsed page includes the homicide totals."""
+
+    if soup.select_one(".crime-title span.crime-text") is None:
+        return False
+
+    # The totals are parsed as integers
+    for selector in [".container-crime.year-to-date", ".container-crime.full-year"]:
+        container = soup.select_one(selector)
+        if container is None:
+            return False
+        totals = [div.text.strip() for div in container.select(".counted-data")]
+        if not totals or not all(total.isdigit() for total in totals):
+            return False
+
+    return True
+
+
 @dataclass
 class PPDHomicideTotal:
     """Total number of homicides scraped from the Philadelphia Police
@@ -49,36 +73,91 @@ class PPDHomicideTotal:
         - Annual totals since 2007 for past years.
         - Year-to-date homicide total for the current year.
 
+    The page is fetched with a plain HTTP request, and only loaded in a
+    headless browser if the response doesn't include the totals (e.g.,
+    if they are rendered with JavaScript).
+
     Source
     ------
     https://www.phillypolice.com/crime-maps-stats/
     """
 
     debug: bool = False
+    retries: int = 3
+    backoff_factor: float = 0.5
+    timeout: float = 30
 
     URL = "https://www.phillypolice.com/crime-data/crime-statistics/"
 
     def __post_init__(self):
 
+        # Try the page's HTML first
+        soup = self._fetch()
+        if soup is None:
+
+            # Never use the network when replaying HTTP responses
+            if HTTP_RECORDER.mode == "replay":
+                raise ValueError("No recorded response with the homicide totals")
+
+            logger.info("Homicide totals not found in the HTML; loading the page")
+            soup = self._fetch_with_browser()
+
+        self.soup = soup
+
+    @cached_property
+    def session(self):
+        """A pooled session that retries failed requests."""
+        return get_session(
+            retries=self.retries,
+            backoff_factor=self.backoff_factor,
+            headers={"User-Agent": USER_AGENT},
+        )
+
+    def _fetch(self):
+        """Fetch and parse the page, returning None if it doesn't include
+        the homicide totals."""
+
+        try:
+            r = self.session.get(self.URL, timeout=self.timeout)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            logger.warning(f"Unable to fetch {self.URL}: {e}")
+            return None
+
+        soup = BeautifulSoup(r.content, "lxml")
+        return soup if has_homicide_totals(soup) else None
+
+    def _fetch_with_browser(self):
+        """Load the page in a headless browser, and parse it once the
+        totals are rendered."""
+
+        from selenium.common.exceptions import TimeoutException
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.support.ui import WebDriverWait
+
         # Get the driver
         driver = get_webdriver(debug=self.debug)
 
-        # Navigate to the page
-        driver.get(self.URL)
-
-        # Wait for the tables to load
-        delay = 5  # seconds
         try:
+            # Navigate to the page
+            driver.get(self.URL)
+
+            # Wait for the tables to load
+            delay = 5  # seconds
             WebDriverWait(driver, delay).until(
                 EC.presence_of_element_located((By.CLASS_NAME, "container-crime"))
             )
 
             # Get the page source
-            self.soup = BeautifulSoup(driver.page_source, "html.parser")
+            return BeautifulSoup(driver.page_source, "lxml")
 
         except TimeoutException:
             raise ValueError("Page took too long to load")
 
+        finally:
+            driver.quit()
+
     @cached_property
     def as_of_date(self):
         """The current "as of" date on the page."""
@@ -161,7 +240,11 @@ class PPDHomicideTotal:
         return df.sort_values("date", ascending=True)
 
     def update(self, force=False):
-        """Update the local data via scraping the PPD website."""
+        """Update the local data via scraping the PPD website.
+
+        When replaying HTTP responses, the data is saved to the replay's
+        output directory instead, so the real data is never overwritten.
+        """
 
         # Load the database
         database = self.get()
@@ -198,8 +281,16 @@ class PPDHomicideTotal:
                 f"New YTD homicide total ({new_homicide_total}) is less than previous YTD total ({old_homicide_total})"
             )
 
+        # Where to save
+        processed_dir, database_path = DATA_DIR / "processed", self.path
+        if HTTP_RECORDER.mode == "replay":
+            processed_dir = HTTP_RECORDER.output_dir
+            database_path = processed_dir / self.path.name
+            processed_dir.mkdir(parents=True, exist_ok=True)
+            logger.info(f"Replaying HTTP responses; saving to {processed_dir}")
+
         # Save it
-        path = DATA_DIR / "processed" / "homicide_totals.json"
+        path = processed_dir / "homicide_totals.json"
         data.set_index("year").to_json(path, orient="index")
 
         # Save it
@@ -208,5 +299,5 @@ class PPDHomicideTotal:
 
         # Drop duplicates and save
         database.drop_duplicates(subset=["date"], keep="last").to_csv(
-            self.path, index=False
+            database_path, index=False
         )
@@ -0,0 +1,223 @@
+"""Run a pipeline of stages, checkpointing the output of each stage."""
+
+import hashlib
+import pickle
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Optional
+
+import simplejson as json
+from cached_property import cached_property
+from loguru import logger
+
+from . import CACHE_DIR, __version__
+
+# Bump this to invalidate all saved checkpoints, e.g., when upgrading a
+# dependency changes the output; changes to the package's own source code
+# invalidate them automatically, but only this version is part of the daily
+# update's fingerprint, so bump it to rerun an update that would be skipped
+PIPELINE_VERSION = 1
+
+# The source code covered by the checkpoint keys
+PACKAGE_DIR = Path(__file__).parent
+
+# Where the stage outputs are saved
+CHECKPOINTS_DIR = CACHE_DIR / "checkpoints"
+
+# The names of the stages of the shootings update, in order
+PIPELINE_STAGES = [
+    "fetch",
+    "normalize",
+    "check",
+    "geo-label",
+    "hot-spot",
+    "courts",
+    "validate",
+    "save",
+    "publish",
+]
+
+
+@lru_cache(maxsize=None)
+def get_code_version():
+    """A hash of the pipeline version and the source code of every module
+    in the package, which includes all of the code the stages call."""
+
+    h = hashlib.sha1(f"{PIPELINE_VERSION}:{__version__}".encode("utf-8"))
+    for path in sorted(PACKAGE_DIR.glob("*.py")):
+        h.update(path.name.encode("utf-8"))
+        h.update(path.read_bytes())
+    return h.hexdigest()
+
+
+def hash_file(path):
+    """The SHA-1 hash of a file's contents, or None if it doesn't exist."""
+
+    path = Path(path)
+    if not path.exists():
+        return None
+    return hashlib.sha1(path.read_bytes()).hexdigest()
+
+
+@dataclass
+class Stage:
+    """A named stage of a pipeline.
+
+    The stage's function is called with the outputs of its input stages,
+    in order. Any other inputs the output depends on (e.g., options, or the
+    hashes of files the stage reads) should be given as ``params``; values
+    that are callables are only evaluated when the stage's key is needed.
+
+    The stage's code version covers the source code of the whole package,
+    since a stage's output also depends on the functions it calls. Any
+    other change to the output, e.g., from upgrading a dependency, requires
+    bumping ``PIPELINE_VERSION``.
+    """
+
+    name: str
+    func: Callable
+    inputs: list = field(default_factory=list)
+    params: dict = field(default_factory=dict)
+
+    @cached_property
+    def code_version(self):
+        """A hash of the package's source code and the pipeline version."""
+        return get_code_version()
+
+    def key(self, input_digests):
+        """The checkpoint key: a hash of the stage's code, parameters, and
+        the contents of its inputs."""
+
+        params = {
+            name: value() if callable(value) else value
+            for name, value in self.params.items()
+        }
+        content = dict(
+            name=self.name,
+            code=self.code_version,
+            params=params,
+            inputs=input_digests,
+        )
+        content = json.dumps(content, sort_keys=True, default=str)
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()[:16]
+
+
+@dataclass
+class Pipeline:
+    """A pipeline of stages whose outputs are checkpointed on disk.
+
+    Each stage's output is saved under a key that hashes the stage's code,
+    parameters and the contents of its inputs. When the pipeline is run
+    again, stages whose key is unchanged are skipped, and their saved
+    output is only loaded if a later stage needs it. Since stages that fail
+    don't save a checkpoint, a rerun resumes from the stage that failed.
+    Only the latest checkpoint of each stage is kept.
+
+    The stages must be given in an order where each stage comes after its
+    inputs. Stages may modify their inputs in place, unless another stage
+    uses the same input.
+    """
+
+    stages: list
+    path: Path = CHECKPOINTS_DIR
+
+    def __post_init__(self):
+        self.names = [stage.name for stage in self.stages]
+        for i, stage in enumerate(self.stages):
+            for name in stage.inputs:
+                if name not in self.names[:i]:
+                    raise ValueError(
+                        f"Input '{name}' of stage '{stage.name}' must be an earlier stage"
+                    )
+
+    def downstream(self, name):
+        """The names of a stage and all stages that depend on it."""
+
+        if name not in self.names:
+            raise ValueError(f"Unknown stage '{name}'; choose from {self.names}")
+
+        out = {name}
+        for stage in self.stages:
+            if any(i in out for i in stage.inputs):
+                out.add(stage.name)
+        return out
+
+    def _checkpoint_path(self, stage, key):
+        return self.path / f"{stage.name}-{key}.pkl"
+
+    def _save(self, stage, key, value):
+        """Save the output of a stage, returning the hash of its contents."""
+
+        content = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.sha1(content).hexdigest()
+
+        # Write the data first, so a checkpoint with metadata is complete
+        self.path.mkdir(parents=True, exist_ok=True)
+        path = self._checkpoint_path(stage, key)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(content)
+        tmp.replace(path)
+        json.dump(dict(digest=digest), path.with_suffix(".json").open(mode="w"))
+
+        # Remove stale checkpoints of this stage
+        for stale in self.path.glob(f"{stage.name}-*"):
+            if stale.stem != path.stem:
+                stale.unlink()
+
+        return digest
+
+    def _load_digest(self, stage, key):
+        """The hash of a saved stage output, or None if there isn't one."""
+
+        path = self._checkpoint_path(stage, key)
+        meta_path = path.with_suffix(".json")
+        if not (path.exists() and meta_path.exists()):
+            return None
+        return json.load(meta_path.open(mode="r"))["digest"]
+
+    def run(self, from_stage: Optional[str] = None):
+        """
+        Run the pipeline, skipping stages whose inputs are unchanged.
+
+        Parameters
+        ----------
+        from_stage : str, optional
+            if given, force this stage and all later stages that depend on
+            it to run
+
+        Returns
+        -------
+        object :
+            the output of the last stage
+        """
+        forced = set() if from_stage is None else self.downstream(from_stage)
+
+        digests = {}
+        outputs = {}
+        paths = {}
+
+        def _get_output(name):
+            if name not in outputs:
+                outputs[name] = pickle.loads(paths[name].read_bytes())
+            return outputs[name]
+
+        for stage in self.stages:
+            key = stage.key([digests[name] for name in stage.inputs])
+            paths[stage.name] = self._checkpoint_path(stage, key)
+
+            # Skip stages with a saved output
+            if stage.name not in forced:
+                digest = self._load_digest(stage, key)
+                if digest is not None:
+                    logger.info(f"Skipping stage '{stage.name}', which is unchanged")
+                    digests[stage.name] = digest
+                    continue
+
+            # Run
+            logger.info(f"Running stage '{stage.name}'")
+            value = stage.func(*[_get_output(name) for name in stage.inputs])
+            digests[stage.name] = self._save(stage, key, value)
+            outputs[stage.name] = value
+
+        return _get_output(self.stages[-1].name)
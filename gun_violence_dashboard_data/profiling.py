@@ -0,0 +1,227 @@
+"""Measure the time and memory used by each stage of the data pipeline."""
+
+import cProfile
+import re
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+import simplejson as json
+from loguru import logger
+
+from . import CACHE_DIR
+
+
+def get_max_rss():
+    """The peak resident set size of the process so far, in bytes."""
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # NOTE: this is in bytes on macOS, but kilobytes on Linux
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+@dataclass
+class StageStats:
+    """The resources used by a stage, summed over all the times it ran."""
+
+    calls: int = 0
+    wall_time: float = 0.0
+    cpu_time: float = 0.0
+    rows_in: Optional[int] = None
+    rows_out: Optional[int] = None
+    bytes_fetched: int = 0
+    max_rss_mb: float = 0.0
+    max_rss_increase_mb: float = 0.0
+    traced_peak_mb: Optional[float] = None
+
+    def count(self, rows_in=None, rows_out=None):
+        """Add to the number of rows going into and out of the stage."""
+
+        # NOTE: cast to int, since numpy counts aren't JSON serializable
+        if rows_in is not None:
+            self.rows_in = (self.rows_in or 0) + int(rows_in)
+        if rows_out is not None:
+            self.rows_out = (self.rows_out or 0) + int(rows_out)
+
+
+@dataclass
+class PipelineReport:
+    """Record the resources used by named stages of the pipeline.
+
+    For each stage, this records the wall and CPU time, the number of rows
+    going in and out (as counted by the stage itself), the bytes fetched
+    over HTTP by clients that report them with ``count_bytes``, and the
+    peak resident set size of the process when the stage finishes. Since
+    the peak RSS never goes down, the increase in the peak RSS over the
+    stage is recorded too, which shows the stages that set a new
+    high-water mark. Stages that run more than once (e.g., for each page of
+    a download) are summed.
+
+    If ``trace_memory`` is set, the peak memory allocated by Python (from
+    ``tracemalloc``) while the stage runs is recorded too; this is off by
+    default since it slows down allocations considerably. If
+    ``profile_stage`` is set, the stage with that name is profiled with
+    ``cProfile``.
+
+    Stages can be nested, in which case the outer stage includes the
+    inner stages. Stages can also run concurrently in several threads,
+    although the bytes fetched are then added to every running stage, and
+    memory can't be traced.
+    """
+
+    trace_memory: bool = False
+    profile_stage: Optional[str] = None
+    profile_dir: Path = CACHE_DIR / "profiles"
+    stages: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        self._running = []
+        self._peaks = []
+        self._profiler = None
+        self._lock = threading.Lock()
+        self.started_at = datetime.now()
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the resources used by the code inside the context,
+        yielding the `StageStats` for the stage."""
+
+        stats = self.stages.setdefault(name, StageStats())
+
+        # Start tracing, carrying the peak so far over to any outer stage
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            elif self._peaks:
+                self._peaks[-1] = max(
+                    self._peaks[-1], tracemalloc.get_traced_memory()[1]
+                )
+            tracemalloc.reset_peak()
+            self._peaks.append(0)
+
+        # Profile the named stage
+        profile = name == self.profile_stage
+        if profile:
+            if self._profiler is None:
+                self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+        with self._lock:
+            self._running.append(stats)
+        start_rss = get_max_rss()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+
+        try:
+            yield stats
+        finally:
+            stats.calls += 1
+            stats.wall_time += time.perf_counter() - start_wall
+            stats.cpu_time += time.process_time() - start_cpu
+
+            # NOTE: remove by identity, since stages running in other threads
+            # can finish in any order
+            with self._lock:
+                i = max(i for i, s in enumerate(self._running) if s is stats)
+                del self._running[i]
+
+            if profile:
+                self._profiler.disable()
+
+            max_rss = get_max_rss()
+            stats.max_rss_mb = max_rss / 1024**2
+            stats.max_rss_increase_mb += (max_rss - start_rss) / 1024**2
+
+            if self.trace_memory:
+                peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+                else:
+                    tracemalloc.stop()
+                stats.traced_peak_mb = max(stats.traced_peak_mb or 0, peak / 1024**2)
+
+    def iterate(self, name, iterable):
+        """Iterate over the input, counting the time spent producing each
+        item (e.g., downloading a page) as a run of the named stage."""
+
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name) as stats:
+                item = next(iterator, None)
+                if item is not None:
+                    stats.count(rows_out=len(item))
+            if item is None:
+                return
+            yield item
+
+    def count_bytes(self, response, *args, **kwargs):
+        """Add the size of an HTTP response to the running stages.
+
+        This can be used as a ``requests`` response hook.
+        """
+        with self._lock:
+            for stats in self._running:
+                stats.bytes_fetched += len(response.content)
+
+    @property
+    def profile_path(self):
+        """Where the profile of the named stage is saved."""
+
+        name = re.sub(r"[^\w.-]+", "_", self.profile_stage)
+        return self.profile_dir / f"{name}.prof"
+
+    def to_dict(self):
+        """The report as a JSON-serializable dict."""
+
+        out = dict(
+            started_at=self.started_at.strftime("%Y-%m-%d %H:%M:%S"),
+            trace_memory=self.trace_memory,
+            stages={name: asdict(stats) for name, stats in self.stages.items()},
+        )
+        if self._profiler is not None:
+            out["profile"] = dict(stage=self.profile_stage, path=str(self.profile_path))
+        return out
+
+    def save(self, path):
+        """Save the report as JSON, and the profile of the named stage."""
+
+        if self._profiler is not None:
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+            self._profiler.dump_stats(self.profile_path)
+            logger.info(
+                f"Saved profile of '{self.profile_stage}' to {self.profile_path}"
+            )
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        json.dump(self.to_dict(), path.open(mode="w"), indent=2)
+
+    def log(self):
+        """Log the resources used by each stage."""
+
+        if not self.stages:
+            return
+
+        lines = []
+        for name, s in self.stages.items():
+            line = (
+                f"  {name}: {s.wall_time:.2f}s wall, {s.cpu_time:.2f}s CPU, "
+                f"{s.max_rss_mb:.1f} MB peak RSS (+{s.max_rss_increase_mb:.1f} MB)"
+            )
+            if s.traced_peak_mb is not None:
+                line += f", {s.traced_peak_mb:.1f} MB traced peak"
+            if s.bytes_fetched:
+                line += f", {s.bytes_fetched / 1024**2:.1f} MB fetched"
+            lines.append(line)
+        logger.info("Pipeline report:\n" + "\n".join(lines))
+
+
+# The report shared by all stages of the pipeline
+REPORT = PipelineReport()
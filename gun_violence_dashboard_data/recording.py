@@ -0,0 +1,157 @@
+"""Record HTTP responses to disk, and replay them to run offline."""
+
+import base64
+import gzip
+import hashlib
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Literal, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+import simplejson as json
+from loguru import logger
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from . import CACHE_DIR
+
+
+def _normalize_url(url):
+    """Sort the query parameters of a URL, so equivalent URLs match."""
+
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit(parts._replace(query=query))
+
+
+@dataclass
+class HTTPRecorder:
+    """Record and replay the HTTP responses of every ``requests`` call.
+
+    This works by replacing ``HTTPAdapter.send``, which all of the HTTP
+    clients used here go through: the Carto client, ``carto2gpd``,
+    ``esri2gpd`` and the boundary cache. Responses are keyed by a hash of
+    the request method, URL (with sorted query parameters) and body, and
+    saved as gzipped JSON files.
+
+    In "record" mode, requests are sent as usual, and each response is
+    saved. In "replay" mode, nothing is sent: the saved responses are
+    returned instead, and requests without a saved response raise a
+    ``requests.ConnectionError``, as if the network were down. Updates
+    that replay responses save their outputs and checkpoints next to the
+    saved responses, so they never overwrite the real data.
+    """
+
+    mode: Optional[Literal["record", "replay"]] = None
+    path: Path = CACHE_DIR / "http"
+
+    def __post_init__(self):
+        self._send = None
+        self._lock = threading.Lock()
+
+    @property
+    def output_dir(self):
+        """Where the outputs of an update are saved when replaying."""
+        return self.path / "output"
+
+    @property
+    def checkpoints_dir(self):
+        """Where the stage checkpoints are saved when replaying."""
+        return self.path / "checkpoints"
+
+    def key(self, request):
+        """The key of the saved response for a prepared request."""
+
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        h = hashlib.sha256(f"{request.method} {_normalize_url(request.url)}\n".encode())
+        h.update(body)
+        return h.hexdigest()
+
+    def save(self, request, response):
+        """Save the response to a request."""
+
+        path = self.path / f"{self.key(request)}.json.gz"
+        content = dict(
+            method=request.method,
+            url=request.url,
+            status_code=response.status_code,
+            reason=response.reason,
+            headers=dict(response.headers),
+            content=base64.b64encode(response.content).decode("ascii"),
+        )
+
+        # NOTE: write to a temporary file first, since requests can be concurrent
+        with self._lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp.write_bytes(gzip.compress(json.dumps(content).encode("utf-8")))
+        tmp.replace(path)
+
+    def load(self, request):
+        """Load the saved response to a request."""
+
+        path = self.path / f"{self.key(request)}.json.gz"
+        if not path.exists():
+            raise requests.ConnectionError(
+                f"No recorded response for {request.method} {request.url}",
+                request=request,
+            )
+        content = json.loads(gzip.decompress(path.read_bytes()))
+
+        # The headers describe the original, possibly compressed, body
+        headers = CaseInsensitiveDict(content["headers"])
+        headers.pop("Content-Encoding", None)
+        headers.pop("Transfer-Encoding", None)
+
+        response = requests.Response()
+        response.status_code = content["status_code"]
+        response.reason = content["reason"]
+        response.headers = headers
+        response.encoding = get_encoding_from_headers(headers)
+        response._content = base64.b64decode(content["content"])
+        response.url = request.url
+        response.request = request
+        return response
+
+    def send(self, adapter, request, **kwargs):
+        """Send a request through the adapter, recording or replaying it."""
+
+        if self.mode == "replay":
+            return self.load(request)
+
+        response = self._send(adapter, request, **kwargs)
+        if self.mode == "record":
+            self.save(request, response)
+        return response
+
+    def install(self):
+        """Start recording or replaying all HTTP requests."""
+
+        if self.mode is None or self._send is not None:
+            return
+
+        self._send = HTTPAdapter.send
+        recorder = self
+
+        def send(adapter, request, **kwargs):
+            return recorder.send(adapter, request, **kwargs)
+
+        HTTPAdapter.send = send
+        logger.info(f"HTTP responses will be {self.mode}ed using {self.path}")
+
+    def uninstall(self):
+        """Stop recording or replaying HTTP requests."""
+
+        if self._send is not None:
+            HTTPAdapter.send = self._send
+            self._send = None
+
+
+# The shared recorder for HTTP requests
+HTTP_RECORDER = HTTPRecorder()
@@ -0,0 +1,128 @@
+"""Publish processed data files to AWS s3."""
+
+import gzip
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import boto3
+import simplejson as json
+from botocore.exceptions import ClientError
+from cached_property import cached_property
+from dotenv import find_dotenv, load_dotenv
+from loguru import logger
+
+from . import BUCKET_NAME, CACHE_DIR
+from .recording import HTTP_RECORDER
+
+
+@dataclass
+class S3Publisher:
+    """Upload files to a public s3 bucket, skipping unchanged files.
+
+    The SHA-256 hash of each uploaded file is saved in a local manifest and
+    in the object's metadata. A file is only uploaded if its hash differs
+    from the manifest or, for files missing from the manifest, from the
+    hash stored on the object itself.
+    """
+
+    bucket: str = BUCKET_NAME
+    manifest_path: Path = CACHE_DIR / "s3_manifest.json"
+    max_workers: int = 4
+    force: bool = False
+
+    @cached_property
+    def client(self):
+        """The s3 client, shared by all uploads."""
+
+        # Load the credentials
+        load_dotenv(find_dotenv())
+        return boto3.client("s3")
+
+    def load_manifest(self):
+        """Load the hashes of the files uploaded previously."""
+
+        if not self.manifest_path.exists():
+            return {}
+        return json.loads(self.manifest_path.read_text())
+
+    def save_manifest(self, manifest):
+        """Save the hashes of the uploaded files."""
+
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        self.manifest_path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+
+    def get_remote_hash(self, key):
+        """The hash stored in the metadata of an uploaded object, if any."""
+
+        try:
+            r = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError:
+            return None
+        return r["Metadata"].get("sha256")
+
+    def upload(self, key, content, content_hash):
+        """Gzip and upload a single JSON file."""
+
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=gzip.compress(content),
+            ContentType="application/json",
+            ContentEncoding="gzip",
+            ACL="public-read",
+            Metadata={"sha256": content_hash},
+        )
+
+    def publish(self, files):
+        """Upload the changed files.
+
+        Parameters
+        ----------
+        files : dict
+            Mapping from the object key to the (uncompressed) JSON content,
+            as bytes
+
+        Returns
+        -------
+        list of str :
+            The keys of the uploaded files
+        """
+        # Never publish data from replayed responses
+        if HTTP_RECORDER.mode == "replay":
+            logger.info(
+                f"Replaying HTTP responses; skipping upload of {len(files)} files"
+            )
+            return []
+
+        manifest = self.load_manifest()
+        hashes = {
+            key: hashlib.sha256(content).hexdigest() for key, content in files.items()
+        }
+
+        def _has_changed(key):
+            if self.force:
+                return True
+            previous = manifest.get(key)
+            if previous is None:
+                previous = self.get_remote_hash(key)
+            return previous != hashes[key]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            changed = [
+                key for key, flag in zip(files, pool.map(_has_changed, files)) if flag
+            ]
+            list(
+                pool.map(lambda key: self.upload(key, files[key], hashes[key]), changed)
+            )
+
+        logger.info(
+            f"Uploaded {len(changed)} of {len(files)} files to s3: {', '.join(changed)}"
+        )
+
+        # Only record the hashes once the uploads have succeeded
+        manifest.update(hashes)
+        self.save_manifest(manifest)
+
+        return changed
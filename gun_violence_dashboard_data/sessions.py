@@ -0,0 +1,57 @@
+"""HTTP sessions that reuse connections and retry failed requests."""
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .profiling import REPORT
+
+
+def get_session(
+    retries=3,
+    backoff_factor=0.5,
+    pool_maxsize=10,
+    allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+    headers=None,
+):
+    """
+    A pooled session that retries failed requests with backoff.
+
+    Requests are retried on connection errors and on 429 and 5xx status
+    codes. The bytes fetched are counted by the pipeline report.
+
+    Parameters
+    ----------
+    retries : int
+        the max number of retries of each request
+    backoff_factor : float
+        the backoff factor between retries, in seconds
+    pool_maxsize : int
+        the max number of connections to keep open to each host
+    allowed_methods : list of str
+        the HTTP methods to retry; by default, only idempotent methods
+    headers : dict, optional
+        headers to send with every request
+
+    Returns
+    -------
+    requests.Session :
+        the session
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=allowed_methods,
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=pool_maxsize)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if headers is not None:
+        session.headers.update(headers)
+
+    # Count the bytes fetched by each stage of the pipeline
+    session.hooks["response"].append(REPORT.count_bytes)
+    return session
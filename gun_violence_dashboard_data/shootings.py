@@ -1,27 +1,35 @@
 """Module for downloading and analyzing the shooting victims database."""
 
-import gzip
-import tempfile
-from dataclasses import dataclass
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
 from typing import Literal, Optional
 
-import boto3
 import carto2gpd
 import geopandas as gpd
 import numpy as np
 import pandas as pd
-import requests
+import shapely
 import simplejson as json
-from dotenv import find_dotenv, load_dotenv
+from cached_property import cached_property
 from loguru import logger
 from pydantic import BaseModel, Field, validator
 from shapely.geometry import Point
 
-from . import BUCKET_NAME, DATA_DIR, EPSG
+from . import CACHE_DIR, DATA_DIR, EPSG, __version__
+from .carto import CartoClient
+from .courts import DATA_PATH as COURTS_DATA_PATH
 from .courts import merge as merge_court_info
 from .geo import *
-from .streets import StreetHotSpots
-from .utils import validate_data_schema
+from .geojson import to_geojson
+from .pipeline import PIPELINE_STAGES, PIPELINE_VERSION, Pipeline, Stage, hash_file
+from .profiling import REPORT
+from .recording import HTTP_RECORDER
+from .s3 import S3Publisher
+from .streets import StreetHotSpots, get_raw_streets_stamp
+from .utils import literal_dtypes, validate_data_schema
 
 
 class Geometry(Point):
@@ -44,149 +52,284 @@ class Geometry(Point):
         pass
 
 
-def upload_to_s3(data, filename):
-    """Upload data to a public AWS s3 bucket."""
+# Where the incident locations looked up for missing geometries are saved
+INCIDENTS_PATH = CACHE_DIR / "incident_locations.fgb"
 
-    # Load the credentials
-    load_dotenv(find_dotenv())
+# Keys without a matching incident are looked up again after this many seconds
+INCIDENT_RETRY_AGE = 12 * 3600
 
-    # Initialize the s3 resource
-    s3 = boto3.client("s3")
 
-    # Compress JSON
-    json_str = data.to_json() + "\n"
-    json_bytes = json_str.encode("utf-8")
+def get_incident_locations(dc_keys):
+    """Look up the locations of criminal incidents by their DC keys.
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmpfile = f"{tmpdir}/{filename}"
-        with gzip.open(tmpfile, "w") as fout:
-            fout.write(json_bytes)
+    Lookups are memoized on disk: keys that were resolved are not queried
+    again on later runs, and keys confirmed to have no matching incident
+    are only queried again once the lookup is older than
+    ``INCIDENT_RETRY_AGE``, since the incident may be added later.
+    """
+    dc_keys = pd.unique(pd.Series(dc_keys, dtype=str))
 
-        # Upload to s3
-        s3.upload_file(
-            tmpfile,
-            BUCKET_NAME,
-            filename,
-            ExtraArgs={
-                "ContentType": "application/json",
-                "ContentEncoding": "gzip",
-                "ACL": "public-read",
-            },
+    # Load the saved lookups
+    if INCIDENTS_PATH.exists():
+        saved = gpd.read_file(INCIDENTS_PATH)
+    else:
+        saved = gpd.GeoDataFrame(
+            {"dc_key": pd.Series(dtype=str), "looked_up_at": pd.Series(dtype=float)},
+            geometry=gpd.GeoSeries(crs="EPSG:4326"),
         )
+    if "looked_up_at" not in saved.columns:
+        saved["looked_up_at"] = np.nan
 
+    # Forget old lookups without a match, so they are retried
+    now = time.time()
+    expired = saved.geometry.isnull() & ~(
+        now - saved["looked_up_at"] < INCIDENT_RETRY_AGE
+    )
+    saved = saved.loc[~expired]
+
+    # Query any new keys
+    # NOTE: np.isin is quadratic for strings, so use a hash-based lookup
+    new_keys = dc_keys[~pd.Index(dc_keys).isin(saved["dc_key"])]
+    if len(new_keys):
+        incidents = CartoClient().get_by_key(
+            "incidents_part1_part2", "dc_key", new_keys, fields=["dc_key"]
+        )
+        if len(incidents):
+            incidents["dc_key"] = incidents["dc_key"].astype(str)
+            incidents = incidents.drop_duplicates(subset=["dc_key"])
+
+        # Keys without a match are saved with a null geometry
+        not_found = new_keys[~pd.Index(new_keys).isin(incidents["dc_key"])]
+        not_found = gpd.GeoDataFrame(
+            {"dc_key": not_found},
+            geometry=gpd.GeoSeries([None] * len(not_found), crs="EPSG:4326"),
+        )
+        logger.info(
+            f"Looked up {len(new_keys)} new DC keys; {len(not_found)} not found"
+        )
 
-def carto2gpd_post(url, table_name, where=None, fields=None):
-    """Query carto API with a post call"""
-
-    # Get the fields
-    if fields is None:
-        fields = "*"
-    else:
-        if "the_geom" not in fields:
-            fields.append("the_geom")
-        fields = ",".join(fields)
-
-    # Build the query
-    query = f"SELECT {fields} FROM {table_name}"
-    if where:
-        query += f" WHERE {where}"
+        found = incidents[["dc_key", "geometry"]].assign(looked_up_at=now)
+        saved = pd.concat(
+            [saved, found, not_found.assign(looked_up_at=now)], ignore_index=True
+        )
 
-    # Make the request
-    params = dict(q=query, format="geojson", skipfields=["cartodb_id"])
-    r = requests.post(url, data=params)
+        INCIDENTS_PATH.parent.mkdir(parents=True, exist_ok=True)
+        save_fgb(saved, INCIDENTS_PATH)
 
-    if r.status_code == 200:
-        return gpd.GeoDataFrame.from_features(r.json(), crs="EPSG:4326")
-    else:
-        raise ValueError("Error querying carto API")
+    return saved.loc[saved["dc_key"].isin(dc_keys) & saved.geometry.notnull()]
 
 
 def add_geographic_info(df):
-    """Add geographic info."""
+    """Add geographic info to the input data, in place.
 
-    # Get a fresh copy
-    df = df.copy().reset_index(drop=True)
+    The locations are given by the "x" and "y" columns of the input data, in
+    EPSG:2272; missing locations are NaN.
+    """
 
-    # The original length
-    original_length = len(df)
+    x = df["x"].to_numpy(copy=True)
+    y = df["y"].to_numpy(copy=True)
 
     # Check city limits
-    city_limits = get_city_limits().to_crs(df.crs)
-    outside_limits = ~df.geometry.within(city_limits.squeeze().geometry)
+    city_limits = get_city_limits().squeeze().geometry
+    shapely.prepare(city_limits)
+    outside_limits = ~shapely.contains_xy(city_limits, x, y)
     missing = outside_limits.sum()
 
-    # Set missing geometry to null
+    # Set missing locations to null
     logger.info(f"{missing} shootings outside city limits")
     if missing > 0:
-        df.loc[outside_limits, "geometry"] = np.nan
-
-    # Try to replace any missing geometries from criminal incidents
-    dc_key_list = ", ".join(
-        df.loc[df.geometry.isnull(), "dc_key"].apply(lambda x: f"'{x}'")
-    )
-
-    # Query with a post request
-    url = "https://phl.carto.com/api/v2/sql"
-    table_name = "incidents_part1_part2"
-    where = f"dc_key IN ( {dc_key_list} )"
-    incidents = carto2gpd_post(url, table_name, where=where, fields=["dc_key"]).to_crs(
-        df.crs
-    )
-    incidents["dc_key"] = incidents["dc_key"].astype(str)
+        x[outside_limits] = np.nan
+        y[outside_limits] = np.nan
+
+    # Try to replace any missing locations from criminal incidents
+    # NOTE: small incremental batches often have nothing to look up
+    missing_sel = ~has_xy(x, y)
+    matches = 0
+    if missing_sel.any():
+        incidents = get_incident_locations(df.loc[missing_sel, "dc_key"]).to_crs(
+            epsg=EPSG
+        )
 
-    # Did we get any matches
-    matches = len(incidents)
-    logger.info(f"Found {matches} matches for {missing} missing geometries")
+        # Did we get any matches
+        matches = len(incidents)
+        logger.info(f"Found {matches} matches for {missing} missing geometries")
 
     # Merge
     if matches > 0:
-        missing_sel = df.geometry.isnull()
-        missing = df.loc[missing_sel]
-        df2 = missing.drop(columns=["geometry"]).merge(
-            incidents[["dc_key", "geometry"]].drop_duplicates(subset=["dc_key"]),
-            on="dc_key",
-            how="left",
-        )
-        df = pd.concat([df.loc[~missing_sel], df2]).reset_index(drop=True)
-
-    def _add_geo_info(data, geo):
-        out = gpd.sjoin(data, geo, how="left", predicate="within")
-
-        # NOTE: sometimes this will match multiple geo boundaries
-        # REMOVE THEM
-        duplicated = out.index.duplicated()
-        if duplicated.sum():
-            out = out.loc[~duplicated]
-
-        return out.drop(labels=["index_right"], axis=1)
-
-    # Add geographic columns
-    geo_funcs = [
-        get_zip_codes,
-        get_police_districts,
-        get_council_districts,
-        get_neighborhoods,
-        get_school_catchments,
-        get_pa_house_districts,
-        get_pa_senate_districts,
-    ]
-    for geo_func in geo_funcs:
-        df = df.pipe(_add_geo_info, geo_func().to_crs(df.crs))
-
-    # if geo columns are missing, geometry should be empty point
-    df.loc[df["neighborhood"].isnull(), "geometry"] = np.nan
-
-    # Check the length
-    if len(df) != original_length:
-        raise ValueError("Length of data has changed; this shouldn't happen!")
+        incidents = incidents.drop_duplicates(subset=["dc_key"]).set_index("dc_key")
+        dc_keys = df.loc[missing_sel, "dc_key"]
+        x[missing_sel] = dc_keys.map(incidents.geometry.x).values
+        y[missing_sel] = dc_keys.map(incidents.geometry.y).values
+
+    # Points are only needed for the spatial index
+    valid = has_xy(x, y)
+    points = xy_to_points(x[valid], y[valid])
+
+    # Add geographic columns, using the overlay of all boundary layers
+    layers = [func() for func in BOUNDARY_FUNCS]
+    labels = BoundaryLabeler([get_boundary_overlay(layers)]).label(points)
+
+    # Fall back to the individual layers for any points outside the overlay
+    unmatched = np.all([pd.isnull(values) for values in labels.values()], axis=0)
+    if unmatched.any():
+        fallback = BoundaryLabeler(layers).label(points[unmatched])
+        for column, values in fallback.items():
+            labels[column][unmatched] = values
+
+    for column, values in labels.items():
+        out = np.full(len(df), np.nan, dtype=object)
+        out[valid] = values
+        df[column] = out
+
+    # if geo columns are missing, the location should be missing too
+    missing_geo = df["neighborhood"].isnull().values
+    x[missing_geo] = np.nan
+    y[missing_geo] = np.nan
+    df["x"] = x
+    df["y"] = y
 
     return df
 
 
-def load_existing_shootings_data():
-    """Load existing shootings data."""
+# FlatGeobuf snapshot of the processed data, saved in the cache (rather than
+# committed next to the GeoJSON files)
+SNAPSHOT_PATH = CACHE_DIR / "shootings.fgb"
+
+
+def load_existing_shootings_data(columns=None, years=None):
+    """
+    Load existing shootings data.
+
+    This reads the FlatGeobuf snapshot written by ``ShootingVictimsData.save``,
+    which is much faster to parse than the GeoJSON files, falling back to the
+    per-year GeoJSON files if the snapshot is missing.
+
+    Parameters
+    ----------
+    columns : list of str, optional
+        only load these columns; geometries are only loaded if "geometry"
+        is included
+    years : list of int, optional
+        only load data for these years
+
+    Returns
+    -------
+    data :
+        a GeoDataFrame, or a DataFrame if geometries were not loaded
+    """
+    read_geometry = columns is None or "geometry" in columns
+    if columns is not None:
+        columns = [col for col in columns if col != "geometry"]
+
+    # Read the snapshot, only selecting the requested data
+    # NOTE: FlatGeobuf is row-oriented, so every feature is still decoded
+    if SNAPSHOT_PATH.exists():
+        where = None
+        if years is not None:
+            where = f"year IN ({', '.join(str(int(year)) for year in years)})"
+
+            # NOTE: the filtered column must be read too
+            if columns is not None:
+                columns = columns + ["year"]
+        df = gpd.read_file(
+            SNAPSHOT_PATH, columns=columns, read_geometry=read_geometry, where=where
+        )
+        return df.drop(columns=["year"], errors="ignore")
+
+    # Fall back to the GeoJSON files
     files = sorted((DATA_DIR / "processed").glob("shootings_20*.json"))
-    return pd.concat([gpd.read_file(f) for f in files])
+    if years is not None:
+        files = [f for f in files if int(f.stem.split("_")[-1]) in years]
+    return pd.concat(
+        [gpd.read_file(f, columns=columns, read_geometry=read_geometry) for f in files],
+        ignore_index=True,
+    )
+
+
+def save_shootings_snapshot(data, path=None):
+    """Save a FlatGeobuf snapshot of the processed data."""
+
+    if path is None:
+        path = SNAPSHOT_PATH
+    path.parent.mkdir(parents=True, exist_ok=True)
+    save_fgb(data.to_crs(epsg=4326).assign(year=lambda df: df.date.dt.year), path)
+
+
+# The boundary labels added by the geographic enrichment step
+LABEL_FIELDS = [
+    "zip_code",
+    "police_district",
+    "council_district",
+    "neighborhood",
+    "school_name",
+    "house_district",
+    "senate_district",
+]
+
+# The columns set by the geographic enrichment step
+GEO_FIELDS = LABEL_FIELDS + ["x", "y"]
+
+# The columns added by the hot spot enrichment step
+STREET_FIELDS = ["segment_id", "street_name", "block_number"]
+
+# The columns added by the geographic and hot spot enrichment steps
+ENRICHED_FIELDS = LABEL_FIELDS + STREET_FIELDS + ["x", "y"]
+
+# The columns of the enriched rows that are saved for the next run
+STATE_FIELDS = ["cartodb_id", "row_hash"] + ENRICHED_FIELDS
+
+# Where the enriched rows from the last run are saved
+STATE_PATH = CACHE_DIR / "shootings_state.fgb"
+
+
+def hash_rows(df):
+    """Hash each row of the formatted (but not yet enriched) upstream data.
+
+    The hash covers every attribute column and the point coordinates, so any
+    upstream edit to a victim's record changes the hash.
+    """
+    columns = sorted(col for col in df.columns if col not in ["x", "y"])
+    values = df[columns + ["x", "y"]]
+    return pd.util.hash_pandas_object(values, index=False).values.view("int64")
+
+
+def load_enriched_state():
+    """Load the enriched rows saved by the last run, if available.
+
+    The versions of the boundaries and streets the rows were enriched with
+    are stored in the ``versions`` attribute of the returned frame.
+    """
+    if not STATE_PATH.exists():
+        return None
+
+    # Load the versions
+    versions = {}
+    meta_path = STATE_PATH.with_suffix(".json")
+    if meta_path.exists():
+        versions = json.load(meta_path.open(mode="r"))
+
+    state = gpd.read_file(STATE_PATH)
+    x, y = get_xy(state.geometry)
+    state = pd.DataFrame(state.drop(columns=["geometry"])).assign(x=x, y=y)
+    state.attrs["versions"] = versions
+    return state
+
+
+def save_enriched_state(state, versions, path=None):
+    """Save the enriched rows so the next run can skip unchanged victims,
+    along with the versions of the boundaries and streets they were
+    enriched with."""
+
+    if path is None:
+        path = STATE_PATH
+    path.parent.mkdir(parents=True, exist_ok=True)
+    state = gpd.GeoDataFrame(
+        state.drop(columns=["x", "y"]),
+        geometry=xy_to_points(state["x"].values, state["y"].values),
+        crs=f"EPSG:{EPSG}",
+    )
+    save_fgb(state, path)
+    json.dump(versions, path.with_suffix(".json").open(mode="w"))
 
 
 class ShootingVictimsSchema(BaseModel):
@@ -210,9 +353,9 @@ class ShootingVictimsSchema(BaseModel):
     fatal: Literal[True, False] = Field(
         title="Fatal?", description="Whether the incident was fatal."
     )
-    date: str = Field(
+    date: datetime = Field(
         title="Date",
-        description="The datetime of the incident in the format 'Y/m/d H:M:S'",
+        description="The datetime of the incident, saved in the format 'Y/m/d H:M:S'",
     )
     age_group: Literal[
         "Younger than 18", "18 to 30", "31 to 45", "Older than 45", "Unknown"
@@ -295,6 +438,20 @@ class ShootingVictimsSchema(BaseModel):
         return v
 
 
+# Categorical dtypes for the fields with a fixed set of values
+CATEGORICAL_DTYPES = literal_dtypes(ShootingVictimsSchema)
+
+# The format of dates in the saved files
+DATE_FORMAT = "%Y/%m/%d %H:%M:%S"
+
+
+def verify_dc_key_column(values):
+    """Vectorized version of `ShootingVictimsSchema.verify_dc_key`."""
+
+    invalid = values.astype(str).str.endswith(".0") & values.notnull()
+    return invalid.values, "bad string formatting"
+
+
 @dataclass
 class ShootingVictimsData:
     """Class for downloading and analyzing the shooting victims
@@ -302,19 +459,193 @@ class ShootingVictimsData:
 
     debug: bool = False
     ignore_checks: bool = False
+    full: bool = False
+    strict_rowwise: bool = False
+    page_size: Optional[int] = 20000
 
     ENDPOINT: str = "https://phl.carto.com/api/v2/sql"
     TABLE_NAME: str = "shootings"
 
-    @validate_data_schema(ShootingVictimsSchema)
-    def get(self) -> gpd.GeoDataFrame:
-        """Download and return the formatted data."""
+    # The enriched rows, saved alongside the processed files
+    state: Optional[pd.DataFrame] = field(default=None, init=False, repr=False)
+
+    def get_fingerprint(self):
+        """Cheap fingerprint of the upstream inputs to the processed data.
+
+        This runs a single aggregate query against the Carto SQL API that
+        returns the row count, the max ``cartodb_id``, the max date, and a
+        hash over all rows (so edits to existing rows are detected too).
+        The hash of the scraped courts data and cheap version stamps of the
+        boundary layers, the streets and the pipeline are included as well,
+        since those also feed into the processed files; their contents are
+        only hashed by the stages that use them.
+        """
+        query = (
+            "SELECT COUNT(*) AS row_count, "
+            "MAX(cartodb_id) AS max_cartodb_id, "
+            "MAX(date_) AS max_date, "
+            "md5(string_agg(md5(t::text), '' ORDER BY cartodb_id)) AS row_hash "
+            f"FROM {self.TABLE_NAME} t"
+        )
+        fingerprint = CartoClient(endpoint=self.ENDPOINT).query(query)["rows"][0]
+        fingerprint["courts_hash"] = hashlib.md5(
+            COURTS_DATA_PATH.read_bytes()
+        ).hexdigest()
+        fingerprint["layers"] = get_boundary_versions()
+        fingerprint["streets"] = get_raw_streets_stamp()
+        fingerprint["code"] = f"{PIPELINE_VERSION}:{__version__}"
+        return fingerprint
+
+    def has_changed(self, fingerprint):
+        """Whether the upstream data has changed since the last update."""
+
+        # Always process everything for full updates
+        if self.full:
+            return True
+
+        # Compare to the fingerprint saved with the last update
+        meta = json.load((DATA_DIR / "meta.json").open(mode="r"))
+        return meta.get("shootings_fingerprint") != fingerprint
+
+    @cached_property
+    def hotspots(self):
+        """The street hot spots, shared so the streets are only loaded once."""
+        return StreetHotSpots(debug=self.debug)
+
+    @cached_property
+    def layers_version(self):
+        """A hash of the boundary layers used to label the shootings."""
+
+        # NOTE: the layers are loaded concurrently
+        with ThreadPoolExecutor(max_workers=len(BOUNDARY_FUNCS)) as pool:
+            layers = list(pool.map(lambda func: func(), BOUNDARY_FUNCS))
+        return fingerprint_layers(layers)
+
+    @property
+    def state_versions(self):
+        """The versions of the boundaries and streets used for enrichment."""
+        return dict(layers=self.layers_version, streets=self.hotspots.version)
+
+    def label(self, df, state=None):
+        """Add geographic info to the input rows, reusing the saved state
+        for any rows that are unchanged since the last run.
+
+        Rows still missing a location in the saved state are labeled again,
+        in case their location can be looked up now.
+        """
+        with REPORT.stage("enrich:geo") as stage:
+            df = self.enrich_changed(
+                df,
+                state,
+                add_geographic_info,
+                GEO_FIELDS,
+                "geographic info",
+                version=("layers", self.layers_version),
+                complete=["x", "y"],
+            )
+            stage.count(rows_in=len(df), rows_out=df["neighborhood"].notnull().sum())
 
-        if self.debug:
-            logger.debug("Downloading shooting victims database")
+        return df
 
-        # Raw data from carto
-        df = carto2gpd.get(self.ENDPOINT, self.TABLE_NAME)
+    def match_streets(self, df, state=None):
+        """Add hot spot info to the input rows, reusing the saved state for
+        any rows that are unchanged since the last run."""
+
+        with REPORT.stage("enrich:streets") as stage:
+            df = self.enrich_changed(
+                df,
+                state,
+                self.hotspots.merge,
+                STREET_FIELDS,
+                "hot spot info",
+                version=("streets", self.hotspots.version),
+                inputs=["x", "y"],
+            )
+            stage.count(rows_in=len(df), rows_out=df["segment_id"].ne("").sum())
+
+        return df
+
+    def enrich_changed(
+        self, df, state, func, fields, name, version, inputs=(), complete=()
+    ):
+        """Enrich only the rows that were added or changed upstream since
+        the last run, passing unchanged rows through from the saved state.
+
+        The enrichment ``func`` adds the ``fields`` to its input, in place.
+        Rows are also enriched again if any of their ``inputs`` columns
+        differ from the saved state, or if any of their ``complete`` columns
+        are missing in the saved state. If there is no saved state, or it
+        was saved with a different ``(name, value)`` version of the data
+        used for enrichment, all rows are enriched.
+        """
+        # Check the state was enriched with the same boundaries or streets
+        if state is not None:
+            key, value = version
+            if state.attrs.get("versions", {}).get(key) != value:
+                logger.info(f"The {key} have changed since the last run")
+                state = None
+
+        if state is None:
+            if self.debug:
+                logger.debug(f"Adding {name} to all rows")
+            func(df)
+            return df
+
+        # Compare the upstream hashes against the saved state
+        # NOTE: -1 marks rows that are not in the saved state
+        idx = pd.Index(state["cartodb_id"]).get_indexer(df["cartodb_id"])
+        unchanged = (idx >= 0) & (
+            df["row_hash"].values == state["row_hash"].values[idx]
+        )
+        for col in inputs:
+            saved = state[col].values[idx]
+            unchanged &= (df[col].values == saved) | (
+                pd.isnull(df[col].values) & pd.isnull(saved)
+            )
+        for col in complete:
+            unchanged &= pd.notnull(state[col].values[idx])
+        removed = ~state["cartodb_id"].isin(df["cartodb_id"])
+
+        logger.info(
+            f"Incremental update of {name}: {(~unchanged).sum()} new or changed rows, "
+            f"{removed.sum()} removed rows, {unchanged.sum()} unchanged rows"
+        )
+
+        # Unchanged rows keep the enriched fields they already have
+        passthrough = df.loc[unchanged].drop(
+            columns=[col for col in fields if col in df.columns]
+        )
+        for col in fields:
+            passthrough[col] = state[col].values[idx[unchanged]]
+
+        # Nothing to enrich
+        if unchanged.all():
+            return passthrough
+
+        # Combine with the newly enriched rows
+        changed = df.loc[~unchanged].reset_index(drop=True)
+        func(changed)
+        return pd.concat([passthrough, changed], ignore_index=True)
+
+    def download(self):
+        """Yield the raw data from carto, one page at a time.
+
+        Pages are at most ``page_size`` rows; if ``page_size`` is None, the
+        whole table is downloaded in a single request.
+        """
+        if self.page_size is None:
+            yield carto2gpd.get(self.ENDPOINT, self.TABLE_NAME)
+        else:
+            client = CartoClient(endpoint=self.ENDPOINT)
+            for i, page in enumerate(
+                client.iter_pages(self.TABLE_NAME, page_size=self.page_size)
+            ):
+                if self.debug:
+                    logger.debug(f"Downloaded page {i+1} with {len(page)} rows")
+                yield page
+
+    def format(self, df):
+        """Format a chunk of the raw data."""
 
         # Remove officer involved
         df = df.query("officer_involved == 'N'")
@@ -330,7 +661,8 @@ class ShootingVictimsData:
             df.assign(
                 time=lambda df: df.time.replace("<Null>", np.nan).fillna("00:00:00"),
                 date=lambda df: pd.to_datetime(
-                    df.date_.str.slice(0, 10).str.cat(df.time, sep=" ")
+                    df.date_.str.slice(0, 10).str.cat(df.time, sep=" "),
+                    format="%Y-%m-%d %H:%M:%S",
                 ),
                 dc_key=lambda df: df.dc_key.astype(float).astype(int).astype(str),
                 year=lambda df: df.date.dt.year,
@@ -346,17 +678,12 @@ class ShootingVictimsData:
                     ["Younger than 18", "18 to 30", "31 to 45", "Older than 45"],
                     default="Unknown",
                 ),
-                fatal=lambda df: df.fatal.apply(lambda x: True if x == 1 else False),
+                fatal=lambda df: df.fatal.eq(1),
             )
             .assign(
                 race=lambda df: df.race.where(df.latino != 1, other="H"),
             )
             .drop(labels=["point_x", "point_y", "date_", "time", "objectid"], axis=1)
-            .sort_values("date", ascending=False)
-            .reset_index(drop=True)
-            .assign(
-                date=lambda df: df.date.dt.strftime("%Y/%m/%d %H:%M:%S")
-            )  # Convert date back to string
             .to_crs(epsg=EPSG)
         )
 
@@ -365,15 +692,54 @@ class ShootingVictimsData:
         sel = df.race.isin(main_race_categories)
         df.loc[~sel, "race"] = "Other/Unknown"
 
+        # Verify the fields with a fixed set of values, since any other
+        # values would become NaN when cast to categoricals
+        for col, dtype in CATEGORICAL_DTYPES.items():
+            invalid = ~df[col].isin(dtype.categories) & df[col].notnull()
+            if invalid.any():
+                values = sorted(df.loc[invalid, col].astype(str).unique())
+                raise ValueError(f"Found unexpected values for '{col}': {values}")
+
+        # Use categoricals for the fields with a fixed set of values
+        # NOTE: dates are only formatted as strings when saving
+        return df.astype(CATEGORICAL_DTYPES)
+
+    def fetch(self):
+        """Download all of the data from carto, formatting it one page at a
+        time so only one raw page is in memory at once."""
+
+        if self.debug:
+            logger.debug("Downloading shooting victims database")
+
+        chunks = []
+        for chunk in REPORT.iterate("download", self.download()):
+            with REPORT.stage("format-pages") as stage:
+                chunks.append(self.format(chunk))
+                stage.count(rows_in=len(chunk), rows_out=len(chunks[-1]))
+        return pd.concat(chunks, ignore_index=True)
+
+    def normalize(self, df):
+        """Sort the formatted data by date, removing any future dates."""
+
+        df.sort_values("date", ascending=False, inplace=True, ignore_index=True)
+
         # Remove dates in the future
-        future_dates = pd.to_datetime(df.date) > pd.Timestamp.now()
+        future_dates = df.date > pd.Timestamp.now()
         if future_dates.sum() > 0:
             logger.warning(f"Found {future_dates.sum()} future date(s) in the data")
             df = df.loc[~future_dates].reset_index(drop=True)
 
+        return df
+
+    def check(self, df):
+        """Check the number of rows against the existing data, and prepare
+        the rows for enrichment."""
+
         # CHECKS
         if not self.ignore_checks:
-            old_df = load_existing_shootings_data()
+            with REPORT.stage("checks") as stage:
+                old_df = load_existing_shootings_data(columns=["dc_key"])
+                stage.count(rows_in=len(df))
             TOLERANCE = 100
 
             # Check for too many rows
@@ -393,53 +759,257 @@ class ShootingVictimsData:
                     "New data seems to have too few rows...please manually confirm new data is correct."
                 )
 
-        # Add geographic info
-        df = add_geographic_info(df)
+        # Carry the locations as x/y coordinates until the data is output
+        df["x"], df["y"] = get_xy(df.geometry)
+        df = pd.DataFrame(df.drop(columns=["geometry"]))
 
-        # Handle NaN/None
-        df = df.assign(
-            geometry=lambda df: df.geometry.fillna(Point()),
-        )
+        # Fingerprint the upstream rows
+        df["row_hash"] = hash_rows(df)
 
-        # Value-added info for hot spots and court info
-        hotspots = StreetHotSpots(debug=self.debug)
-        df = (
-            df.pipe(hotspots.merge)
-            .pipe(merge_court_info, debug=self.debug)
-            .assign(segment_id=lambda df: df.segment_id.replace("", np.nan))
+        return df
+
+    @cached_property
+    def saved_state(self):
+        """The enriched rows saved by the last run, unless this is a full update."""
+        return None if self.full else load_enriched_state()
+
+    @cached_property
+    def saved_state_version(self):
+        """A hash of the saved state files, unless this is a full update."""
+
+        if self.full:
+            return None
+        return [hash_file(STATE_PATH), hash_file(STATE_PATH.with_suffix(".json"))]
+
+    def merge_courts(self, df):
+        """Sort the enriched rows and add the court info, in place."""
+
+        # Keep a stable order, independent of which rows were enriched
+        df.sort_values(
+            ["date", "cartodb_id"],
+            ascending=[False, True],
+            inplace=True,
+            ignore_index=True,
         )
 
-        # Trim to the schema fields
-        fields = ShootingVictimsSchema.__fields__.keys()
-        df = df[fields]
+        # The boundary labels have few unique values
+        for col in LABEL_FIELDS:
+            df[col] = df[col].astype("category")
+
+        # Save the enriched rows for the next run
+        self.state = df[STATE_FIELDS]
+
+        # Value-added info for court info
+        with REPORT.stage("courts") as stage:
+            merge_court_info(df, debug=self.debug)
+            stage.count(rows_in=len(df), rows_out=df["has_court_case"].sum())
 
         return df
 
-    def save(self, data):
-        """Save annual, processed data files."""
+    def to_output(self, df):
+        """Convert the enriched rows to the output format.
+
+        The input is not modified, since the save stage also uses it.
+        """
+        # Trim to the schema fields
+        fields = list(ShootingVictimsSchema.__fields__.keys())
+        columns = [col for col in fields if col != "geometry"]
+
+        # Missing locations become empty points
+        geometry = xy_to_points(df["x"].values, df["y"].values)
+        out = gpd.GeoDataFrame(df[columns], geometry=geometry, crs=f"EPSG:{EPSG}")
+        out["segment_id"] = out["segment_id"].replace("", np.nan)
+
+        return out[fields]
+
+    def finalize(self, df):
+        """Sort the enriched rows, add the court info, and convert them to
+        the output format, saving the enriched rows for the next run."""
+        return self.to_output(self.merge_courts(df))
+
+    @validate_data_schema(
+        ShootingVictimsSchema, column_validators={"dc_key": verify_dc_key_column}
+    )
+    def validate(self, df) -> gpd.GeoDataFrame:
+        """Convert the enriched rows to the output format, and validate it."""
+        return self.to_output(df)
+
+    def pipeline(self, fingerprint):
+        """
+        The stages of the update, checkpointed so that reruns skip any
+        stages whose inputs are unchanged.
+
+        The geographic and hot spot stages depend on the boundary layers,
+        the streets, and the state saved by the last run, since rows that
+        are unchanged are passed through from the saved state.
+
+        Parameters
+        ----------
+        fingerprint : dict
+            the fingerprint of the upstream data, from `get_fingerprint`
+
+        Returns
+        -------
+        Pipeline :
+            the pipeline, whose output is the list of files published to s3
+        """
+        # The download only depends on the upstream data
+        local = ["courts_hash", "layers", "streets", "code"]
+        fingerprint = {k: v for k, v in fingerprint.items() if k not in local}
+
+        # NOTE: callable parameters are only evaluated if the stage's key is needed
+        stages = [
+            Stage(
+                "fetch",
+                self.fetch,
+                params=dict(fingerprint=fingerprint, ignore_checks=self.ignore_checks),
+            ),
+            Stage(
+                "normalize",
+                self.normalize,
+                inputs=["fetch"],
+                params=dict(today=datetime.now().strftime("%Y-%m-%d")),
+            ),
+            Stage(
+                "check",
+                self.check,
+                inputs=["normalize"],
+                params=dict(ignore_checks=self.ignore_checks),
+            ),
+            Stage(
+                "geo-label",
+                lambda df: self.label(df, self.saved_state),
+                inputs=["check"],
+                params=dict(
+                    layers=lambda: self.layers_version,
+                    full=self.full,
+                    state=lambda: self.saved_state_version,
+                ),
+            ),
+            Stage(
+                "hot-spot",
+                lambda df: self.match_streets(df, self.saved_state),
+                inputs=["geo-label"],
+                params=dict(
+                    streets=lambda: self.hotspots.version,
+                    full=self.full,
+                    state=lambda: self.saved_state_version,
+                ),
+            ),
+            Stage(
+                "courts",
+                self.merge_courts,
+                inputs=["hot-spot"],
+                params=dict(courts=lambda: hash_file(COURTS_DATA_PATH)),
+            ),
+            Stage(
+                "validate",
+                self.validate,
+                inputs=["courts"],
+                params=dict(strict_rowwise=self.strict_rowwise),
+            ),
+            Stage(
+                "save",
+                lambda data, df: self.save(data, state=df[STATE_FIELDS]),
+                inputs=["validate", "courts"],
+            ),
+            Stage("publish", self.publish, inputs=["save"]),
+        ]
+        assert [stage.name for stage in stages] == PIPELINE_STAGES
+
+        # Keep the checkpoints of replayed runs apart from the real ones
+        if HTTP_RECORDER.mode == "replay":
+            return Pipeline(stages, path=HTTP_RECORDER.checkpoints_dir)
+        return Pipeline(stages)
+
+    def run(self, fingerprint=None, from_stage=None):
+        """
+        Run the checkpointed update, returning the files published to s3.
+
+        Parameters
+        ----------
+        fingerprint : dict, optional
+            the fingerprint of the upstream data; if not given, it's fetched
+        from_stage : str, optional
+            the name of a stage to force to run, along with all of the
+            stages after it
+        """
+        if fingerprint is None:
+            fingerprint = self.get_fingerprint()
+
+        # Load the boundaries and the streets in the background, while the
+        # data downloads
+        # NOTE: any errors are raised again when the stages load them
+        with ThreadPoolExecutor(max_workers=len(BOUNDARY_FUNCS) + 1) as pool:
+            for func in BOUNDARY_FUNCS:
+                pool.submit(func)
+            pool.submit(lambda: self.hotspots.block_level_streets)
+
+            return self.pipeline(fingerprint).run(from_stage=from_stage)
+
+    def save(self, data, state=None):
+        """Save annual, processed data files, returning the content of
+        each file by name.
+
+        When replaying HTTP responses, everything is saved to the replay's
+        output directory instead, so the real data is never overwritten.
+        """
+        processed_dir = DATA_DIR / "processed"
+        snapshot_path, state_path = SNAPSHOT_PATH, STATE_PATH
+        if HTTP_RECORDER.mode == "replay":
+            processed_dir = HTTP_RECORDER.output_dir
+            snapshot_path = processed_dir / SNAPSHOT_PATH.name
+            state_path = processed_dir / STATE_PATH.name
+            processed_dir.mkdir(parents=True, exist_ok=True)
+            logger.info(f"Replaying HTTP responses; saving to {processed_dir}")
 
         # Get the years from the date
-        years = pd.to_datetime(data["date"]).dt.year
+        years = data["date"].dt.year
 
         # Get unique years
         # IMPORTANT: this must be int so it is JSON serializable
         unique_years = [int(year) for year in sorted(np.unique(years), reverse=True)]
-        json.dump(unique_years, (DATA_DIR / "processed" / "data_years.json").open("w"))
+        json.dump(unique_years, (processed_dir / "data_years.json").open("w"))
 
         # Save each year's data to separate file
+        files = {}
         for year in unique_years:
             if self.debug:
                 logger.debug(f"Saving {year} shootings as a GeoJSON file")
 
-            # Get data for this year
-            # Save in EPSG = 4326
-            data_yr = data.loc[years == year].to_crs(epsg=4326)
+            with REPORT.stage(f"save:{year}") as stage:
+                # Get data for this year
+                # Save in EPSG = 4326
+                data_yr = data.loc[years == year].to_crs(epsg=4326)
+                data_yr["date"] = data_yr["date"].dt.strftime(DATE_FORMAT)
 
-            data_yr.to_file(
-                DATA_DIR / "processed" / f"shootings_{year}.json",
-                driver="GeoJSON",
-                index=False,
-            )
+                # Encode once, for both the local file and s3
+                content = to_geojson(data_yr, f"shootings_{year}")
+                (processed_dir / f"shootings_{year}.json").write_bytes(content)
+                files[f"shootings_{year}.json"] = content
+                stage.count(rows_out=len(data_yr))
+
+        # Save the FlatGeobuf snapshot
+        if self.debug:
+            logger.debug("Saving shootings snapshot")
+        with REPORT.stage("save:snapshot"):
+            save_shootings_snapshot(data, snapshot_path)
+
+        # Save the enriched rows for the next incremental run
+        state = self.state if state is None else state
+        if state is not None:
+            if self.debug:
+                logger.debug("Saving enriched shootings state")
+            with REPORT.stage("save:state"):
+                save_enriched_state(state, self.state_versions, state_path)
+
+        return files
+
+    def publish(self, files):
+        """Upload the changed files to s3, returning their names."""
+
+        with REPORT.stage("upload") as stage:
+            changed = S3Publisher().publish(files)
+            stage.count(rows_in=len(files), rows_out=len(changed))
 
-            # Save to s3
-            upload_to_s3(data_yr, f"shootings_{year}.json")
+        return changed
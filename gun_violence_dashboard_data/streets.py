@@ -1,16 +1,53 @@
 """Module for calculating shooting hot spots by street block."""
 
+import hashlib
 from dataclasses import dataclass
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
-from cached_property import cached_property
+import shapely
+from cached_property import cached_property, threaded_cached_property
 from loguru import logger
 from shapely import ops
 from shapely.geometry import MultiLineString
 
-from . import DATA_DIR, EPSG
+from . import CACHE_DIR, DATA_DIR, EPSG
+from .geo import save_fgb
+
+# Bump this whenever the way block-level streets are derived changes
+STREETS_ARTIFACT_VERSION = 1
+
+# The raw street layers that block-level streets are derived from
+RAW_STREETS_FOLDERS = ["Street_Centerline", "Street_Network_Types"]
+
+
+def get_raw_streets_stamp():
+    """A cheap version stamp of the raw street files, without reading them:
+    the name and size of each file, and the artifact version.
+
+    NOTE: modification times aren't used, since they change with every
+    fresh checkout of the repository.
+    """
+    stamp = [STREETS_ARTIFACT_VERSION]
+    for folder in RAW_STREETS_FOLDERS:
+        for path in sorted((DATA_DIR / "raw" / folder).iterdir()):
+            stamp.append([path.name, path.stat().st_size])
+    return stamp
+
+
+# The key and fields of the saved point-to-segment assignments
+ASSIGNMENT_KEYS = ["cartodb_id", "x", "y"]
+ASSIGNMENT_FIELDS = ["segment_id", "street_name", "block_number", "length"]
+ASSIGNMENT_DTYPES = {
+    "cartodb_id": "int64",
+    "x": "int64",
+    "y": "int64",
+    "segment_id": "float64",
+    "street_name": "object",
+    "block_number": "float64",
+    "length": "float64",
+}
 
 
 def _as_string(x):
@@ -27,65 +64,112 @@ def get_largest_contiguous_line(x):
         return multi
 
 
-def _match_to_streets(data, streets, key, buffer):
+def get_largest_contiguous_lines(geometry, groups):
     """
-    Associate the input Point data set with the nearest street.
+    Vectorized version of `get_largest_contiguous_line` for many groups
+    of lines at once.
 
     Parameters
     ----------
-    data : GeoDataFrame
-        dataframe holding the Point data set, in this case, either
-        the work orders or requests for street defects
-    key : str
-        the unique identifier for the input data
-    buffer : int
-        the buffer in feet to search for matches
+    geometry : GeoSeries
+        the LineString geometries
+    groups : array_like
+        the group number (from 0 to N-1) of each line
+
+    Returns
+    -------
+    lines : ndarray
+        the largest contiguous line for each group
     """
-    # get only the unique values
-    unique_data = data.drop_duplicates(subset=key)
+    groups = np.asarray(groups)
+    lines = np.asarray(geometry.array)
 
-    # save the original un-buffered streets data
-    streets_geometry = streets.geometry.copy()
+    if not (shapely.get_type_id(lines) == 1).all():
+        raise ValueError("Only LineString geometries can be merged by block")
 
-    # buffer the geometry and do the spatial join
-    streets.geometry = streets.geometry.buffer(buffer)
-    df = gpd.sjoin(unique_data, streets, predicate="within", how="left")
+    # Merge the lines in each group, keeping the original order within groups
+    order = np.argsort(groups, kind="stable")
+    merged = shapely.line_merge(
+        shapely.multilinestrings(lines[order], indices=groups[order])
+    )
 
-    # missing vs matched
-    missing = df.loc[df["street_name"].isnull()].copy()
-    matched = df.loc[~df["street_name"].isnull()].copy()
+    # Take the longest part of merged lines that are still MultiLineStrings;
+    # ties go to the first part, like np.argmax
+    multi = np.flatnonzero(shapely.get_type_id(merged) == 5)
+    parts, part_group = shapely.get_parts(merged[multi], return_index=True)
+    part_number = np.arange(len(parts))
+    order = np.lexsort((part_number, -shapely.length(parts), part_group))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = part_group[order][1:] != part_group[order][:-1]
 
-    # remove any missing that are in matched
-    missing = missing.loc[missing.index.difference(matched.index)]
-    missing = missing.loc[~missing.duplicated(subset=key)]
+    out = merged.copy()
+    out[multi[part_group[order][first]]] = parts[order][first]
+    return out
 
-    def get_closest(x):
-        match = streets.loc[streets_geometry.distance(x.geometry).idxmin()]
-        match = match.drop("geometry")
-        x.update(match)
-        return x
 
-    # add a distance column
-    matched_streets = streets_geometry.loc[matched["index_right"]]
-    D = matched.reset_index(drop=True).distance(matched_streets.reset_index(drop=True))
-    matched["distance"] = D.values
+def match_to_nearest_segment(points, segments, max_distance):
+    """
+    Find the nearest line segment to each point.
 
-    # drop duplicates, keeping the first
-    matched = matched.sort_values(by="distance", ascending=True)
-    matched = matched.loc[~matched.index.duplicated(keep="first")]
-    matched = matched.drop(labels=["distance"], axis=1)
+    Points are first matched to segments within ``max_distance`` using a
+    bounded nearest query, and any remaining points are matched with an
+    unbounded query. If multiple segments are equally close, the segment
+    with the lowest index wins.
 
-    # get matches for missing
-    Y = missing.apply(get_closest, axis=1)
+    Parameters
+    ----------
+    points : GeoSeries
+        the Point data set
+    segments : GeoSeries
+        the line segments to match to
+    max_distance : float
+        the distance to search for matches before falling back to an
+        unbounded search
+
+    Returns
+    -------
+    segment_idx : ndarray
+        the position of the nearest segment, or -1 for missing/empty points
+    distance : ndarray
+        the distance to the nearest segment
+    ties : ndarray
+        the number of segments at the same nearest distance
+    """
+    points = np.asarray(points.array)
+    tree = shapely.STRtree(np.asarray(segments.array))
+
+    # Initialize the outputs
+    segment_idx = np.full(len(points), -1, dtype=np.intp)
+    distance = np.full(len(points), np.nan)
+    ties = np.zeros(len(points), dtype=np.intp)
+
+    # Bounded search first, then unbounded for the rest
+    remaining = np.flatnonzero(~(shapely.is_missing(points) | shapely.is_empty(points)))
+    for search_distance in [max_distance, None]:
+        if not len(remaining):
+            break
+
+        (point_idx, tree_idx), dist = tree.query_nearest(
+            points[remaining],
+            max_distance=search_distance,
+            return_distance=True,
+            all_matches=True,
+        )
+        point_idx = remaining[point_idx]
 
-    # join missing and matched
-    out = pd.concat([matched, Y], axis=0)
+        # Keep the lowest segment index for each point, and count the ties
+        order = np.lexsort((tree_idx, point_idx))
+        point_idx, tree_idx, dist = point_idx[order], tree_idx[order], dist[order]
+        first = np.ones(len(point_idx), dtype=bool)
+        first[1:] = point_idx[1:] != point_idx[:-1]
 
-    # merge back in to original data frame
-    columns = list(set(streets.columns) - {"geometry"})
-    out = pd.merge(data, out[columns + [key]], on=key, how="left")
+        segment_idx[point_idx[first]] = tree_idx[first]
+        distance[point_idx[first]] = dist[first]
+        ties[point_idx[first]] = np.diff(np.append(np.flatnonzero(first), len(first)))
 
-    return out.drop_duplicates()  # Drop duplicates
+        remaining = remaining[segment_idx[remaining] < 0]
+
+    return segment_idx, distance, ties
 
 
 @dataclass
@@ -125,51 +209,183 @@ class StreetHotSpots:
         )
 
     @cached_property
+    def version(self):
+        """The version of the block-level streets: a hash of the raw
+        street files and the artifact version."""
+
+        h = hashlib.sha1(str(STREETS_ARTIFACT_VERSION).encode("utf-8"))
+        for folder in RAW_STREETS_FOLDERS:
+            for path in sorted((DATA_DIR / "raw" / folder).iterdir()):
+                h.update(path.name.encode("utf-8"))
+                h.update(path.read_bytes())
+        return h.hexdigest()[:16]
+
+    @property
+    def artifact_path(self):
+        """The saved block-level streets for the current version."""
+        return CACHE_DIR / "streets" / f"block_level_streets_{self.version}.fgb"
+
+    @threaded_cached_property
     def block_level_streets(self):
-        """Load streets, aggregated by block"""
+        """Load streets, aggregated by block.
+
+        These are built once for each version of the raw street files and
+        saved, so later runs only need to load the saved copy. This is
+        thread-safe, so the streets can be loaded in the background.
+        """
+        path = self.artifact_path
+        if path.exists():
+            return gpd.read_file(path)
+
+        if self.debug:
+            logger.debug("Building block-level streets")
+        streets = self._build_block_level_streets()
+
+        # Save, removing any stale versions
+        path.parent.mkdir(parents=True, exist_ok=True)
+        for stale in path.parent.glob("block_level_streets_*.fgb"):
+            stale.unlink()
+        save_fgb(streets, path)
+
+        return streets
+
+    def _build_block_level_streets(self):
+        """Aggregate the street segments by block."""
+
+        # Group streets by block
+        streets = self.streets_directory.dropna(subset=["street_name"])
+        grouped = streets.groupby(["street_name", "block_number"])
 
         # Load streets
         return gpd.GeoDataFrame(
             (
-                self.streets_directory.dropna(subset=["street_name"])
-                .groupby(["street_name", "block_number"])
-                .agg(
-                    {
-                        "geometry": lambda x: get_largest_contiguous_line(x),
-                        "length": "sum",
-                    }
-                )
+                grouped["length"]
+                .sum()
                 .reset_index()
+                .assign(
+                    geometry=get_largest_contiguous_lines(
+                        streets.geometry, grouped.ngroup().values
+                    )
+                )
                 .reset_index()
                 .rename(columns={"index": "segment_id"})
-            ),
+            )[["segment_id", "street_name", "block_number", "geometry", "length"]],
             crs=f"EPSG:{EPSG}",
             geometry="geometry",
         )
 
-    def merge(self, data):
-        """Calculate hot spots and merge data into input dataframe."""
+    @property
+    def assignments_path(self):
+        """The saved point-to-segment assignments for the current version."""
+        return CACHE_DIR / "streets" / f"segment_assignments_{self.version}.csv"
+
+    def load_assignments(self):
+        """Load the saved point-to-segment assignments, if any."""
 
-        # Drop empty sgeometries
-        data_geo = data.loc[~data.geometry.is_empty].copy()
+        path = self.assignments_path
+        if not path.exists():
+            return pd.DataFrame(columns=ASSIGNMENT_KEYS + ASSIGNMENT_FIELDS).astype(
+                ASSIGNMENT_DTYPES
+            )
+        return pd.read_csv(path, dtype=ASSIGNMENT_DTYPES)
+
+    def save_assignments(self, assignments):
+        """Save the point-to-segment assignments, removing any stale versions."""
+
+        path = self.assignments_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        for stale in path.parent.glob("segment_assignments_*.csv"):
+            if stale != path:
+                stale.unlink()
+        assignments.to_csv(path, index=False)
+
+    def match(self, data):
+        """Match points, given by the "x" and "y" columns of the input data,
+        to the nearest street block, only running the matching for points
+        not already in the saved assignments.
+
+        The returned assignments are aligned with the rows of the input.
+        """
+
+        # Points are identified by ID and location, rounded to the nearest foot
+        keys = pd.DataFrame(
+            {
+                "cartodb_id": data["cartodb_id"].values,
+                "x": np.round(data["x"].values).astype("int64"),
+                "y": np.round(data["y"].values).astype("int64"),
+            }
+        )
+
+        # Look up the saved assignments
+        # NOTE: a left merge keeps the order of the keys
+        saved = self.load_assignments()
+        df = keys.merge(saved, on=ASSIGNMENT_KEYS, how="left")
+        missing = df["segment_id"].isnull().values
+        if self.debug:
+            logger.debug(
+                f"Found {(~missing).sum()} saved street assignments; "
+                f"matching {missing.sum()} points"
+            )
 
         # Match to streets, using radius of 200 ft
+        # NOTE: points are only created for the points we need to match
+        if missing.any():
+            streets = self.block_level_streets
+            points = gpd.GeoSeries(
+                gpd.points_from_xy(data["x"].values[missing], data["y"].values[missing])
+            )
+            segment_idx, distance, ties = match_to_nearest_segment(
+                points, streets.geometry, max_distance=200
+            )
+            matched = segment_idx >= 0
+            if ties.sum() > matched.sum():
+                logger.debug(
+                    f"{(ties > 1).sum()} points are equidistant to multiple streets"
+                )
+
+            # Fill in the matched street info, by position
+            rows = np.flatnonzero(missing)[matched]
+            for field in ASSIGNMENT_FIELDS:
+                values = df[field].to_numpy(dtype=ASSIGNMENT_DTYPES[field], copy=True)
+                values[rows] = streets[field].values[segment_idx[matched]]
+                df[field] = values
+
+            # Save the new assignments
+            self.save_assignments(
+                pd.concat([saved, df.iloc[rows]], ignore_index=True).drop_duplicates(
+                    subset=ASSIGNMENT_KEYS, keep="last"
+                )
+            )
+
+        return df.astype(ASSIGNMENT_DTYPES)
+
+    def merge(self, data):
+        """Calculate hot spots and add them to the input dataframe, in place.
+
+        The locations of the input data are given by its "x" and "y"
+        columns, in EPSG:2272; missing locations are NaN.
+        """
+
+        # Drop missing locations
+        valid = (data["x"].notnull() & data["y"].notnull()).values
+
+        # Match to streets
         if self.debug:
             logger.debug("Calculating street hot spots")
-        df = _match_to_streets(
-            data_geo, self.block_level_streets.copy(), "cartodb_id", buffer=200
-        )
+        df = self.match(data.loc[valid, ["cartodb_id", "x", "y"]])
 
         # Drop long segments for visual aesthetics
-        df = df.query("length < 5200")
+        short = df["length"].values < 5200
+        rows = np.flatnonzero(valid)[short]
 
-        # The new fields we want to merge
-        new_info = df[["cartodb_id", "segment_id", "street_name", "block_number"]]
+        # Add the new hot spot fields, aligned by position
+        for field in ["segment_id", "street_name", "block_number"]:
+            values = np.full(len(data), np.nan, dtype=ASSIGNMENT_DTYPES[field])
+            values[rows] = df[field].values[short]
+            data[field] = values
+        data["segment_id"] = data["segment_id"].fillna("").apply(_as_string)
 
-        # Merge new hot spot segment id back into the original data frame
-        return data.merge(new_info, on="cartodb_id", how="left").assign(
-            segment_id=lambda df: df.segment_id.fillna("").apply(_as_string)
-        )
+        return data
 
     def save(self):
         """"""
@@ -0,0 +1,70 @@
+"""Run the parts of the daily update, and record their results.
+
+NOTE: every daily update imports this module, so it shouldn't import any
+heavy dependencies, e.g., the ones for validating the shootings data.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+import simplejson as json
+
+
+def run_concurrently(funcs: list, max_workers: Optional[int] = None) -> list:
+    """
+    Run functions concurrently in threads, waiting for all of them to finish.
+
+    Parameters
+    ----------
+    funcs : list of callable
+        the functions to run, without any arguments
+    max_workers : int, optional
+        the max number of threads; defaults to one per function
+
+    Returns
+    -------
+    list :
+        the result of each function, or the exception it raised
+    """
+    if max_workers is None:
+        max_workers = max(len(funcs), 1)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(func) for func in funcs]
+
+    return [future.exception() or future.result() for future in futures]
+
+
+def update_json(path: Path, updates: dict, remove: Optional[list] = None) -> dict:
+    """
+    Merge updates into a JSON file, replacing the file atomically so it is
+    never partially written.
+
+    Parameters
+    ----------
+    path : Path
+        the JSON file to update, which holds a dict
+    updates : dict
+        the keys to add or change
+    remove : list of str, optional
+        any keys to remove
+
+    Returns
+    -------
+    dict :
+        the updated contents
+    """
+    path = Path(path)
+    content = json.load(path.open(mode="r")) if path.exists() else {}
+    for key in remove or []:
+        content.pop(key, None)
+    content.update(updates)
+
+    tmp = path.with_suffix(f"{path.suffix}.tmp")
+    with tmp.open(mode="w") as f:
+        json.dump(content, f)
+    os.replace(tmp, path)
+
+    return content
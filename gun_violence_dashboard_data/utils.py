@@ -1,33 +1,197 @@
 """Utilities for dashboard data processing."""
 
-from typing import Callable
+import typing
+from datetime import datetime
+from typing import Callable, Optional
 
+import numpy as np
 import pandas as pd
+import shapely
 from pydantic import BaseModel
 from pydantic.main import ModelMetaclass
+from shapely.geometry.base import BaseGeometry
 
+from .profiling import REPORT
 
-def validate_data_schema(data_schema: ModelMetaclass) -> Callable:
+# The maximum number of errors to include in a validation error message
+MAX_REPORTED_ERRORS = 10
+
+
+def _check_type(values: pd.Series, type_: type) -> np.ndarray:
+    """Return a mask of the non-null values that are not of the given type."""
+
+    # Categoricals: check each category once
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        invalid = _check_type(pd.Series(values.cat.categories), type_)
+        return invalid[values.cat.codes.values]
+
+    # Shapely geometries, e.g., points
+    if isinstance(type_, type) and issubclass(type_, BaseGeometry):
+        arr = np.asarray(values, dtype=object)
+        invalid = ~shapely.is_geometry(arr)
+        invalid[~invalid] = (
+            shapely.get_type_id(arr[~invalid]) != shapely.get_type_id(type_())
+        )
+        return invalid
+
+    # Floats: anything that can be coerced to a number
+    if type_ is float:
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(
+            values
+        ):
+            return np.zeros(len(values), dtype=bool)
+        return pd.to_numeric(values, errors="coerce").isnull().values
+
+    # Datetimes
+    if type_ is datetime:
+        if pd.api.types.is_datetime64_any_dtype(values):
+            return np.zeros(len(values), dtype=bool)
+        return ~values.map(lambda v: isinstance(v, datetime)).values
+
+    # Strings
+    if type_ is str:
+        if pd.api.types.infer_dtype(values, skipna=True) in ("string", "empty"):
+            return np.zeros(len(values), dtype=bool)
+        return ~values.map(lambda v: isinstance(v, str)).values
+
+    raise TypeError(f"Unsupported field type for columnar validation: {type_}")
+
+
+def literal_dtypes(data_schema: ModelMetaclass) -> dict:
     """
-    This decorator will validate a pandas.DataFrame against the given data_schema.
+    Return a dict mapping the name of each string Literal field in the
+    data_schema to a categorical dtype with the allowed values.
+    """
+    dtypes = {}
+    for name, field in data_schema.__fields__.items():
+        type_ = field.outer_type_
+        if typing.get_origin(type_) is typing.Literal:
+            allowed = typing.get_args(type_)
+            if all(isinstance(value, str) for value in allowed):
+                dtypes[name] = pd.CategoricalDtype(list(allowed))
+    return dtypes
+
+
+def validate_columns(
+    df: pd.DataFrame,
+    data_schema: ModelMetaclass,
+    column_validators: Optional[dict] = None,
+) -> None:
+    """
+    Validate a pandas.DataFrame against the given data_schema, column by column.
+
+    This checks the same constraints as validating each row with pydantic:
+    missing required columns, nulls in non-optional fields, Literal fields
+    via ``isin``, and field types via dtype checks. Pydantic validators cannot
+    be vectorized automatically, so vectorized equivalents are passed as
+    ``column_validators``, a dict mapping a field name to a function that
+    takes the column and returns a tuple of (boolean mask of invalid rows,
+    error message).
+
+    Raises
+    ------
+    ValueError
+        If any rows fail validation; the message names the rows and fields.
+    """
+    if column_validators is None:
+        column_validators = {}
+
+    errors = []
+    for name, field in data_schema.__fields__.items():
+
+        # Check for missing columns
+        if name not in df.columns:
+            if field.required:
+                errors.append((None, name, "field required"))
+            continue
+
+        values = df[name]
+        null = values.isnull().values
+        type_ = field.outer_type_
+        checks = []
+
+        # Nullability
+        if not field.allow_none:
+            checks.append((null, "none is not an allowed value"))
+
+        # Literal sets
+        if typing.get_origin(type_) is typing.Literal:
+            allowed = list(typing.get_args(type_))
+            invalid = ~values.isin(allowed).values & ~null
+            checks.append((invalid, f"unexpected value; permitted: {allowed}"))
+
+        # Types
+        else:
+            invalid = np.zeros(len(values), dtype=bool)
+            invalid[~null] = _check_type(values.loc[~null], type_)
+            checks.append((invalid, f"value is not a valid {type_.__name__}"))
+
+        # Custom vectorized validators
+        if name in column_validators:
+            invalid, message = column_validators[name](values)
+            checks.append((np.asarray(invalid, dtype=bool), message))
+
+        # Collect the errors
+        for invalid, message in checks:
+            for idx in df.index[invalid][:MAX_REPORTED_ERRORS]:
+                errors.append((idx, name, message))
+            if invalid.sum() > MAX_REPORTED_ERRORS:
+                errors.append((None, name, f"{invalid.sum()} invalid rows in total"))
+
+    if errors:
+        lines = [
+            f"row {idx}, field '{name}': {message}"
+            if idx is not None
+            else f"field '{name}': {message}"
+            for idx, name, message in errors
+        ]
+        raise ValueError(
+            f"{len(errors)} validation error(s) for {data_schema.__name__}\n"
+            + "\n".join(lines)
+        )
+
+
+def validate_rows(df: pd.DataFrame, data_schema: ModelMetaclass) -> None:
+    """
+    Validate a pandas.DataFrame against the given data_schema, row by row.
+
     Source
     ------
     https://www.inwt-statistics.com/read-blog/pandas-dataframe-validation-with-pydantic-part-2.html
     """
+    # check result of the function execution against the data_schema
+    df_dict = df.to_dict(orient="records")
+
+    # Wrap the data_schema into a helper class for validation
+    class ValidationWrap(BaseModel):
+        df_dict: list[data_schema]  # type: ignore
+
+    # Do the validation
+    _ = ValidationWrap(df_dict=df_dict)
+
+
+def validate_data_schema(
+    data_schema: ModelMetaclass, column_validators: Optional[dict] = None
+) -> Callable:
+    """
+    This decorator will validate a pandas.DataFrame against the given data_schema.
+
+    By default, the data is validated column by column (see `validate_columns`).
+    If the decorated method's instance has a truthy ``strict_rowwise`` attribute,
+    each row is validated with pydantic instead.
+    """
 
     def Inner(func: Callable) -> Callable:
         def wrapper(*args, **kwargs):  # type: ignore
             res = func(*args, **kwargs)
             if isinstance(res, pd.DataFrame):
-                # check result of the function execution against the data_schema
-                df_dict = res.to_dict(orient="records")
-
-                # Wrap the data_schema into a helper class for validation
-                class ValidationWrap(BaseModel):
-                    df_dict: list[data_schema]  # type: ignore
-
-                # Do the validation
-                _ = ValidationWrap(df_dict=df_dict)
+                rowwise = args and getattr(args[0], "strict_rowwise", False)
+                with REPORT.stage("validation") as stage:
+                    if rowwise:
+                        validate_rows(res, data_schema)
+                    else:
+                        validate_columns(res, data_schema, column_validators)
+                    stage.count(rows_in=len(res), rows_out=len(res))
             else:
                 raise TypeError(
                     "Your Function is not returning an object of type pandas.DataFrame."
@@ -38,4 +202,4 @@ def validate_data_schema(data_schema: ModelMetaclass) -> Callable:
 
         return wrapper
 
-    return Inner
\ No newline at end of file
+    return Inner
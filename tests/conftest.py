@@ -0,0 +1,96 @@
+"""Shared fixtures for the tests."""
+
+import re
+import threading
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+import simplejson as json
+
+
+@dataclass
+class LocalServer:
+    """A local HTTP server that stands in for a remote API.
+
+    Each request is recorded, and answered by the ``handler``, which is
+    called with the request and returns the status code, content type and
+    body of the response.
+    """
+
+    handler: Optional[Callable] = None
+    requests: list = field(default_factory=list)
+    url: str = ""
+
+
+@pytest.fixture
+def local_server():
+    """A local HTTP server, whose handler is set by the test."""
+
+    server = LocalServer()
+
+    class Handler(BaseHTTPRequestHandler):
+        def respond(self):
+            # Parse the request
+            parts = urlsplit(self.path)
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length).decode("utf-8")
+            request = dict(
+                method=self.command,
+                path=parts.path,
+                params=parse_qs(parts.query),
+                data=parse_qs(body),
+            )
+            server.requests.append(request)
+
+            status, content_type, content = server.handler(request)
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        do_GET = do_POST = respond
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{httpd.server_port}"
+
+    yield server
+
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def carto_server(local_server):
+    """A stand-in for the Carto SQL API that answers lookups by key with
+    the locations in its ``incidents``, a mapping from DC key to (lng, lat)."""
+
+    local_server.incidents = {}
+
+    def handler(request):
+        query = request["data"]["q"][0]
+        keys = re.findall(r"'([^']*)'", query)
+        features = [
+            dict(
+                type="Feature",
+                properties=dict(dc_key=key),
+                geometry=dict(
+                    type="Point", coordinates=list(local_server.incidents[key])
+                ),
+            )
+            for key in keys
+            if key in local_server.incidents
+        ]
+        content = json.dumps(dict(type="FeatureCollection", features=features))
+        return 200, "application/json", content.encode("utf-8")
+
+    local_server.handler = handler
+    return local_server
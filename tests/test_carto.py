@@ -0,0 +1,74 @@
+"""Tests for the Carto SQL API client."""
+
+import re
+
+import pytest
+import requests
+
+from gun_violence_dashboard_data.carto import CartoClient
+
+
+def queried_keys(request):
+    """The keys looked up by a request to the Carto API."""
+    return re.findall(r"'([^']*)'", request["data"]["q"][0])
+
+
+def test_get_by_key_batches(carto_server):
+    carto_server.incidents = {"1": (-75.16, 39.95), "3": (-75.18, 39.97)}
+
+    client = CartoClient(endpoint=carto_server.url, batch_size=2)
+    out = client.get_by_key(
+        "incidents_part1_part2", "dc_key", ["1", "2", "3", "1", "4"], fields=["dc_key"]
+    )
+
+    # Duplicates are only looked up once, in batches of at most 2 keys
+    batches = sorted(queried_keys(request) for request in carto_server.requests)
+    assert batches == [["1", "2"], ["3", "4"]]
+
+    assert sorted(out["dc_key"]) == ["1", "3"]
+    assert out.crs == "EPSG:4326"
+    assert out.geometry.x.tolist() == [
+        carto_server.incidents[key][0] for key in out["dc_key"]
+    ]
+
+
+def test_get_by_key_without_matches(carto_server):
+    client = CartoClient(endpoint=carto_server.url)
+
+    out = client.get_by_key("incidents_part1_part2", "dc_key", ["1"], fields=["dc_key"])
+    assert len(out) == 0
+    assert list(out.columns) == ["dc_key", "geometry"]
+
+    # Nothing to look up
+    out = client.get_by_key("incidents_part1_part2", "dc_key", [], fields=["dc_key"])
+    assert len(out) == 0
+    assert len(carto_server.requests) == 1
+
+
+def test_retries_server_errors(carto_server):
+    carto_server.incidents = {"1": (-75.16, 39.95)}
+    handler = carto_server.handler
+
+    # Fail the first two requests
+    def flaky(request):
+        if len(carto_server.requests) <= 2:
+            return 503, "text/plain", b"Service Unavailable"
+        return handler(request)
+
+    carto_server.handler = flaky
+
+    client = CartoClient(endpoint=carto_server.url, retries=3, backoff_factor=0)
+    out = client.get_by_key("incidents_part1_part2", "dc_key", ["1"], fields=["dc_key"])
+
+    assert len(carto_server.requests) == 3
+    assert out["dc_key"].tolist() == ["1"]
+
+
+def test_gives_up_after_retries(carto_server):
+    carto_server.handler = lambda request: (503, "text/plain", b"Service Unavailable")
+
+    client = CartoClient(endpoint=carto_server.url, retries=2, backoff_factor=0)
+    with pytest.raises(requests.exceptions.RetryError):
+        client.query("SELECT 1")
+
+    assert len(carto_server.requests) == 3
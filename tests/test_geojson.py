@@ -0,0 +1,137 @@
+"""Tests for the fast GeoJSON serialization."""
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Point
+
+from gun_violence_dashboard_data import DATA_DIR
+from gun_violence_dashboard_data.geojson import (
+    format_coordinate,
+    format_real,
+    to_geojson,
+)
+from gun_violence_dashboard_data.shootings import DATE_FORMAT
+
+# Coordinates that GDAL rounds or trims, as (x, y)
+EDGE_COORDINATES = [
+    (0.0, 0.0),
+    (-75.0, 40.0),
+    (-75.16, 39.95),
+    (0.1 + 0.2, 1 / 3),
+    (-75.123456789012345, 39.987654321098765),
+    (-75.00000000000001, 39.99999999999999),
+    (-75.100000000000001, 39.900000000000006),
+    (-75.19999999999999, 40.000000000000014),
+    (-75.1234500000001, 39.9876599999999),
+    (1e-10, -1e-10),
+    (2683000.5000000005, 235000.99999999997),
+    (-179.99999999999997, 89.99999999999999),
+]
+
+# Property values that GDAL rounds, or writes with an exponent
+EDGE_REALS = [
+    0.0,
+    2.0,
+    -17.0,
+    100.0,
+    0.1,
+    0.1 + 0.2,
+    1 / 3,
+    1.0000000000000002,
+    0.9999999999999999,
+    123456789.12345679,
+    2.5e-7,
+    1e16,
+    1e20,
+    -1.5e-300,
+    np.nan,
+]
+
+
+def gdal_geojson(df, name, tmp_path):
+    """Write the data with GDAL, returning the bytes of the file."""
+
+    path = tmp_path / f"{name}.json"
+    df.to_file(path, driver="GeoJSON", index=False)
+    return path.read_bytes()
+
+
+def test_format_edge_cases():
+    assert format_coordinate(-75.0) == "-75.0"
+    assert format_coordinate(0.1 + 0.2) == "0.3"
+    assert format_coordinate(39.99999999999999) == "40.0"
+    assert format_real(2.0) == "2.0"
+    assert format_real(0.1 + 0.2) == "0.3"
+    assert format_real(1e20) == "1e+20"
+
+
+def test_matches_gdal_for_edge_coordinates(tmp_path):
+    x, y = zip(*EDGE_COORDINATES)
+    df = gpd.GeoDataFrame(
+        {"value": np.arange(len(x))},
+        geometry=gpd.points_from_xy(x, y),
+        crs="EPSG:4326",
+    )
+    assert to_geojson(df, "coords") == gdal_geojson(df, "coords", tmp_path)
+
+
+def test_matches_gdal_for_edge_reals(tmp_path):
+    df = gpd.GeoDataFrame(
+        {"value": EDGE_REALS},
+        geometry=[Point(-75.16, 39.95)] * len(EDGE_REALS),
+        crs="EPSG:4326",
+    )
+    assert to_geojson(df, "reals") == gdal_geojson(df, "reals", tmp_path)
+
+
+def test_matches_gdal_for_shootings(tmp_path):
+    rng = np.random.default_rng(42)
+    n = 500
+
+    # Missing and empty points are written as null geometries
+    geometry = list(
+        gpd.points_from_xy(rng.uniform(-75.28, -74.96, n), rng.uniform(39.87, 40.14, n))
+    )
+    geometry[0] = None
+    geometry[7] = Point()
+    geometry[-1] = None
+
+    dates = pd.Timestamp("2023-01-01") + pd.to_timedelta(
+        rng.integers(0, 365 * 24 * 3600, n), unit="s"
+    )
+    df = gpd.GeoDataFrame(
+        {
+            "dc_key": [str(202300000000 + i) for i in range(n)],
+            "race": pd.Categorical(rng.choice(["B", "W", "H", "A"], n)),
+            "sex": rng.choice(["M", "F"], n),
+            "fatal": rng.uniform(size=n) < 0.2,
+            "date": dates.strftime(DATE_FORMAT),
+            "age": np.where(rng.uniform(size=n) < 0.1, np.nan, rng.integers(1, 90, n)),
+            "zip_code": np.where(rng.uniform(size=n) < 0.1, None, "19104"),
+            "street_name": rng.choice(["N BROAD ST", 'O"NEIL ST', "CAFÉ AVE"], n),
+            "block_number": rng.integers(0, 100, n) * 100.0,
+            "has_court_case": rng.uniform(size=n) < 0.5,
+        },
+        geometry=geometry,
+        crs="EPSG:4326",
+    )
+    assert to_geojson(df, "shootings_2023") == gdal_geojson(
+        df, "shootings_2023", tmp_path
+    )
+
+
+@pytest.mark.parametrize(
+    "path",
+    sorted((DATA_DIR / "processed").glob("shootings_*.json")),
+    ids=lambda path: path.stem,
+)
+def test_matches_gdal_for_processed_files(path, tmp_path):
+    df = gpd.read_file(path)
+    df["date"] = df["date"].dt.strftime(DATE_FORMAT)
+
+    # Both the published files and a fresh GDAL write are reproduced exactly
+    content = to_geojson(df, path.stem)
+    assert content == path.read_bytes()
+    assert content == gdal_geojson(df, path.stem, tmp_path)
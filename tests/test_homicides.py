@@ -0,0 +1,83 @@
+"""Tests for scraping the homicide totals from the PPD's website."""
+
+from pathlib import Path
+
+import pandas as pd
+import pytest
+from bs4 import BeautifulSoup
+
+from gun_violence_dashboard_data.homicides import PPDHomicideTotal
+from gun_violence_dashboard_data.recording import HTTP_RECORDER
+
+# Saved copies of the page, with and without the totals rendered
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+PAGE = (FIXTURES_DIR / "ppd_crime_statistics.html").read_bytes()
+UNRENDERED_PAGE = (FIXTURES_DIR / "ppd_crime_statistics_unrendered.html").read_bytes()
+
+
+@pytest.fixture
+def ppd_server(local_server, monkeypatch):
+    """Serve the saved page locally, in place of the PPD's website."""
+
+    local_server.page = PAGE
+    local_server.handler = lambda request: (200, "text/html", local_server.page)
+    monkeypatch.setattr(PPDHomicideTotal, "URL", local_server.url + "/crime-stats/")
+    return local_server
+
+
+@pytest.fixture
+def browser(monkeypatch):
+    """Load the rendered page in place of the browser, recording each load."""
+
+    loads = []
+
+    def _fetch_with_browser(self):
+        loads.append(self.URL)
+        return BeautifulSoup(PAGE, "lxml")
+
+    monkeypatch.setattr(PPDHomicideTotal, "_fetch_with_browser", _fetch_with_browser)
+    return loads
+
+
+def test_parses_page_without_browser(ppd_server, browser):
+    homicides = PPDHomicideTotal()
+
+    assert browser == []
+    assert len(ppd_server.requests) == 1
+
+    assert homicides.as_of_date == pd.Timestamp("2026-10-15 11:59:00")
+    assert homicides.ytd_totals.to_dict("list") == {
+        "year": [2026, 2025],
+        "ytd": [201, 250],
+    }
+    assert homicides.annual_totals.to_dict("list") == {
+        "year": [2025, 2024],
+        "annual": [300, 350],
+    }
+
+
+def test_loads_unrendered_page_in_browser(ppd_server, browser):
+    ppd_server.page = UNRENDERED_PAGE
+
+    homicides = PPDHomicideTotal()
+
+    assert browser == [PPDHomicideTotal.URL]
+    assert homicides.ytd_totals["ytd"].tolist() == [201, 250]
+
+
+def test_loads_page_in_browser_after_server_errors(ppd_server, browser):
+    ppd_server.handler = lambda request: (503, "text/plain", b"Service Unavailable")
+
+    PPDHomicideTotal(retries=2, backoff_factor=0)
+
+    assert len(ppd_server.requests) == 3
+    assert browser == [PPDHomicideTotal.URL]
+
+
+def test_replay_without_totals_raises(ppd_server, browser, monkeypatch):
+    monkeypatch.setattr(HTTP_RECORDER, "mode", "replay")
+    ppd_server.page = UNRENDERED_PAGE
+
+    with pytest.raises(ValueError, match="No recorded response"):
+        PPDHomicideTotal()
+    assert browser == []
@@ -0,0 +1,99 @@
+"""Tests for the command line tool."""
+
+import hashlib
+import subprocess
+import sys
+
+import pytest
+from click.testing import CliRunner
+
+from gun_violence_dashboard_data import DATA_DIR
+from gun_violence_dashboard_data.__main__ import cli
+from gun_violence_dashboard_data.homicides import PPDHomicideTotal
+from gun_violence_dashboard_data.recording import HTTP_RECORDER
+
+from .test_homicides import browser, ppd_server
+
+# Run a homicides-only update in a fresh interpreter, without scraping or
+# saving anything, and print the modules it imported
+HOMICIDES_ONLY_UPDATE = """
+import sys
+from pathlib import Path
+
+from click.testing import CliRunner
+
+from gun_violence_dashboard_data import __main__ as main
+from gun_violence_dashboard_data.homicides import PPDHomicideTotal
+
+main.DATA_DIR = main.CACHE_DIR = Path(sys.argv[1])
+PPDHomicideTotal.__post_init__ = lambda self: None
+PPDHomicideTotal.update = lambda self, force=False: None
+
+CliRunner().invoke(
+    main.cli, ["daily-update", "--homicides-only"], catch_exceptions=False
+)
+print("\\n".join(sys.modules))
+"""
+
+
+def test_homicides_only_update_skips_shootings_dependencies(tmp_path):
+    result = subprocess.run(
+        [sys.executable, "-c", HOMICIDES_ONLY_UPDATE, str(tmp_path)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = set(result.stdout.split())
+
+    assert "gun_violence_dashboard_data.homicides" in modules
+    for name in [
+        "geopandas",
+        "pydantic",
+        "shapely",
+        "gun_violence_dashboard_data.utils",
+    ]:
+        assert name not in modules
+    assert (tmp_path / "meta.json").exists()
+
+
+def hash_data_files():
+    """Hash the committed data files that an update can change."""
+
+    paths = [DATA_DIR / "meta.json", DATA_DIR / "raw" / "homicide_totals_daily.csv"]
+    paths += sorted((DATA_DIR / "processed").glob("*.json"))
+    return {path.name: hashlib.sha1(path.read_bytes()).hexdigest() for path in paths}
+
+
+@pytest.fixture
+def recorder(monkeypatch):
+    """The shared HTTP recorder, reset after the test."""
+
+    monkeypatch.setattr(HTTP_RECORDER, "mode", None)
+    monkeypatch.setattr(HTTP_RECORDER, "path", HTTP_RECORDER.path)
+    yield HTTP_RECORDER
+    HTTP_RECORDER.uninstall()
+
+
+def test_replay_does_not_change_data(ppd_server, browser, recorder, tmp_path):
+    fixtures = tmp_path / "http"
+
+    # Record the page
+    recorder.mode, recorder.path = "record", fixtures
+    recorder.install()
+    PPDHomicideTotal()
+    recorder.uninstall()
+    assert len(ppd_server.requests) == 1
+
+    # Replay the update
+    before = hash_data_files()
+    args = ["--http-mode", "replay", "--http-fixtures", str(fixtures)]
+    args += ["daily-update", "--homicides-only", "--force-homicide-update"]
+    result = CliRunner().invoke(cli, args, catch_exceptions=False)
+    assert result.exit_code == 0
+
+    # Nothing was requested or changed, and the outputs were saved elsewhere
+    assert len(ppd_server.requests) == 1
+    assert browser == []
+    assert hash_data_files() == before
+    output = sorted(path.name for path in recorder.output_dir.iterdir())
+    assert output == ["homicide_totals.json", "homicide_totals_daily.csv", "meta.json"]
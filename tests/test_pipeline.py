@@ -0,0 +1,103 @@
+"""Tests for running checkpointed pipelines."""
+
+import pytest
+
+from gun_violence_dashboard_data import pipeline
+from gun_violence_dashboard_data.pipeline import Pipeline, Stage, get_code_version
+
+
+@pytest.fixture
+def calls():
+    """The names of the stages that ran."""
+    return []
+
+
+@pytest.fixture
+def make_pipeline(calls, tmp_path):
+    """Make a pipeline that adds to a start value, multiplies the result,
+    and formats it; a stage can be made to fail."""
+
+    def make(start=1, fail=None):
+        def stage(name, func):
+            def run(*args):
+                calls.append(name)
+                if name == fail:
+                    raise ValueError(f"Stage '{name}' failed")
+                return func(*args)
+
+            return run
+
+        stages = [
+            Stage("add", stage("add", lambda: start + 1), params=dict(start=start)),
+            Stage("multiply", stage("multiply", lambda x: x * 10), inputs=["add"]),
+            Stage("format", stage("format", lambda x: f"{x}"), inputs=["multiply"]),
+        ]
+        return Pipeline(stages, path=tmp_path)
+
+    return make
+
+
+@pytest.fixture(autouse=True)
+def clear_code_version():
+    """Recompute the code version in each test."""
+    get_code_version.cache_clear()
+    yield
+    get_code_version.cache_clear()
+
+
+def test_checkpoints_are_reused(make_pipeline, calls):
+    assert make_pipeline().run() == "20"
+    assert calls == ["add", "multiply", "format"]
+
+    # Nothing runs again
+    calls.clear()
+    assert make_pipeline().run() == "20"
+    assert calls == []
+
+    # Changed parameters rerun the stage, and the stages that use it
+    calls.clear()
+    assert make_pipeline(start=2).run() == "30"
+    assert calls == ["add", "multiply", "format"]
+
+
+def test_resumes_from_failed_stage(make_pipeline, calls):
+    with pytest.raises(ValueError, match="'multiply' failed"):
+        make_pipeline(fail="multiply").run()
+    assert calls == ["add", "multiply"]
+
+    calls.clear()
+    assert make_pipeline().run() == "20"
+    assert calls == ["multiply", "format"]
+
+
+def test_from_stage_forces_downstream_stages(make_pipeline, calls):
+    make_pipeline().run()
+
+    calls.clear()
+    assert make_pipeline().run(from_stage="multiply") == "20"
+    assert calls == ["multiply", "format"]
+
+    with pytest.raises(ValueError, match="Unknown stage"):
+        make_pipeline().run(from_stage="missing")
+
+
+def test_code_version_change_invalidates_checkpoints(make_pipeline, calls, monkeypatch):
+    make_pipeline().run()
+
+    calls.clear()
+    monkeypatch.setattr(pipeline, "PIPELINE_VERSION", pipeline.PIPELINE_VERSION + 1)
+    get_code_version.cache_clear()
+    assert make_pipeline().run() == "20"
+    assert calls == ["add", "multiply", "format"]
+
+
+def test_code_version_covers_source_code(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, "PACKAGE_DIR", tmp_path)
+    module = tmp_path / "module.py"
+
+    module.write_text("x = 1\n")
+    version = get_code_version()
+
+    module.write_text("x = 2\n")
+    get_code_version.cache_clear()
+    assert get_code_version() != version
@@ -0,0 +1,127 @@
+"""Tests for publishing the processed data files to s3."""
+
+import gzip
+import hashlib
+
+import pytest
+import simplejson as json
+from botocore.exceptions import ClientError
+
+from gun_violence_dashboard_data.recording import HTTP_RECORDER
+from gun_violence_dashboard_data.s3 import S3Publisher
+
+
+class LocalS3:
+    """An in-memory stand-in for the s3 client.
+
+    Uploads of the keys in ``fail`` raise an error, like a failed request.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = []
+        self.fail = set()
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            error = {"Error": {"Code": "404", "Message": "Not Found"}}
+            raise ClientError(error, "HeadObject")
+        return {"Metadata": self.objects[(Bucket, Key)]["Metadata"]}
+
+    def put_object(self, Bucket, Key, **kwargs):
+        if Key in self.fail:
+            error = {"Error": {"Code": "500", "Message": "Internal Error"}}
+            raise ClientError(error, "PutObject")
+        self.uploads.append(Key)
+        self.objects[(Bucket, Key)] = kwargs
+
+
+@pytest.fixture
+def s3():
+    return LocalS3()
+
+
+@pytest.fixture
+def publisher(s3, tmp_path):
+    """Create publishers that share the s3 stand-in and the manifest."""
+
+    def _publisher(**kwargs):
+        out = S3Publisher(manifest_path=tmp_path / "s3_manifest.json", **kwargs)
+        out.client = s3
+        return out
+
+    return _publisher
+
+
+def make_files(*years, version=1):
+    return {
+        f"shootings_{year}.json": json.dumps(dict(year=year, version=version)).encode()
+        for year in years
+    }
+
+
+def test_uploads_files(s3, publisher):
+    files = make_files(2022, 2023)
+    assert sorted(publisher().publish(files)) == sorted(files)
+
+    for key, content in files.items():
+        uploaded = s3.objects[(publisher().bucket, key)]
+        assert gzip.decompress(uploaded["Body"]) == content
+        assert uploaded["ContentEncoding"] == "gzip"
+        assert uploaded["Metadata"] == {"sha256": hashlib.sha256(content).hexdigest()}
+
+
+def test_skips_unchanged_files_in_manifest(s3, publisher):
+    publisher().publish(make_files(2022, 2023))
+
+    # Only the changed year is uploaded
+    files = {**make_files(2022), **make_files(2023, version=2)}
+    assert publisher().publish(files) == ["shootings_2023.json"]
+    assert publisher().publish(files) == []
+    assert sorted(s3.uploads) == [
+        "shootings_2022.json",
+        "shootings_2023.json",
+        "shootings_2023.json",
+    ]
+
+    # Unless forced
+    assert sorted(publisher(force=True).publish(files)) == sorted(files)
+
+
+def test_skips_unchanged_files_without_manifest(s3, publisher):
+    publisher().publish(make_files(2022, 2023))
+    publisher().manifest_path.unlink()
+
+    # The hashes are read from the uploaded objects' metadata
+    files = {**make_files(2022), **make_files(2023, version=2), **make_files(2024)}
+    changed = publisher().publish(files)
+    assert sorted(changed) == ["shootings_2023.json", "shootings_2024.json"]
+
+    # And saved to the manifest again
+    assert publisher().load_manifest() == {
+        key: hashlib.sha256(content).hexdigest() for key, content in files.items()
+    }
+
+
+def test_failed_upload_leaves_manifest_unchanged(s3, publisher):
+    publisher().publish(make_files(2022, 2023))
+    manifest = publisher().manifest_path.read_text()
+
+    s3.fail.add("shootings_2023.json")
+    with pytest.raises(ClientError):
+        publisher().publish(make_files(2022, 2023, version=2))
+    assert publisher().manifest_path.read_text() == manifest
+
+    # The failed file is uploaded by the next run
+    s3.fail.clear()
+    assert "shootings_2023.json" in publisher().publish(
+        make_files(2022, 2023, version=2)
+    )
+
+
+def test_replay_mode_skips_uploads(s3, publisher, monkeypatch):
+    monkeypatch.setattr(HTTP_RECORDER, "mode", "replay")
+
+    assert publisher().publish(make_files(2022)) == []
+    assert s3.uploads == []
+    assert not publisher().manifest_path.exists()
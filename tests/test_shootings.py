@@ -0,0 +1,225 @@
+"""Tests for the shooting victims data."""
+
+from functools import partial
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import simplejson as json
+from shapely.geometry import Point
+
+from gun_violence_dashboard_data import geo, shootings
+from gun_violence_dashboard_data.carto import CartoClient
+from gun_violence_dashboard_data.geo import save_fgb
+from gun_violence_dashboard_data.recording import HTTP_RECORDER
+
+from .test_carto import queried_keys
+from .test_utils import shootings_output
+
+
+@pytest.fixture
+def lookup(carto_server, tmp_path, monkeypatch):
+    """Look up incident locations from the stand-in Carto API, saving the
+    lookups to a temporary file."""
+
+    monkeypatch.setattr(shootings, "INCIDENTS_PATH", tmp_path / "incidents.fgb")
+    monkeypatch.setattr(
+        shootings, "CartoClient", partial(CartoClient, endpoint=carto_server.url)
+    )
+    return shootings.get_incident_locations
+
+
+def test_incident_lookups_are_memoized(carto_server, lookup):
+    carto_server.incidents = {"1": (-75.16, 39.95), "2": (-75.17, 39.96)}
+
+    out = lookup(["1", "9"])
+    assert out["dc_key"].tolist() == ["1"]
+    assert out.geometry.x.tolist() == [-75.16]
+    assert len(carto_server.requests) == 1
+
+    # The hit and the miss are both saved
+    out = lookup(["1", "9"])
+    assert out["dc_key"].tolist() == ["1"]
+    assert len(carto_server.requests) == 1
+
+    # Only the new key is looked up
+    out = lookup(["1", "9", "2"])
+    assert sorted(out["dc_key"]) == ["1", "2"]
+    assert queried_keys(carto_server.requests[-1]) == ["2"]
+
+
+def test_misses_are_retried_after_max_age(carto_server, lookup, monkeypatch):
+    carto_server.incidents = {"1": (-75.16, 39.95)}
+    lookup(["1", "9"])
+
+    # The incident is added later, but the miss isn't retried yet
+    carto_server.incidents["9"] = (-75.2, 40.0)
+    assert lookup(["1", "9"])["dc_key"].tolist() == ["1"]
+    assert len(carto_server.requests) == 1
+
+    # Once the miss is too old, only it is looked up again
+    monkeypatch.setattr(shootings, "INCIDENT_RETRY_AGE", 0)
+    assert sorted(lookup(["1", "9"])["dc_key"]) == ["1", "9"]
+    assert queried_keys(carto_server.requests[-1]) == ["9"]
+
+    # Hits are never looked up again
+    lookup(["1", "9"])
+    assert len(carto_server.requests) == 2
+
+
+def test_lookups_saved_without_a_time_are_retried(carto_server, lookup):
+    carto_server.incidents = {"1": (-75.16, 39.95), "9": (-75.2, 40.0)}
+
+    # Lookups saved before the lookup time was recorded
+    saved = gpd.GeoDataFrame(
+        {"dc_key": ["1", "9"]},
+        geometry=gpd.GeoSeries([Point(-75.16, 39.95), None], crs="EPSG:4326"),
+    )
+    save_fgb(saved, shootings.INCIDENTS_PATH)
+
+    assert sorted(lookup(["1", "9"])["dc_key"]) == ["1", "9"]
+    assert [queried_keys(request) for request in carto_server.requests] == [["9"]]
+
+
+def test_fingerprint_does_not_load_boundaries(local_server, tmp_path, monkeypatch):
+    def handler(request):
+        if request["method"] == "POST":
+            content = dict(rows=[dict(row_count=2, row_hash="abc")])
+        else:
+            content = dict(editingInfo=dict(lastEditDate=123))
+        return 200, "application/json", json.dumps(content).encode("utf-8")
+
+    local_server.handler = handler
+    monkeypatch.setattr(
+        geo, "BOUNDARY_URLS", {"zip_code": f"{local_server.url}/zip_codes"}
+    )
+    monkeypatch.setattr(geo, "BOUNDARY_CACHE", geo.BoundaryCache(path=tmp_path))
+    monkeypatch.setattr(geo.esri2gpd, "get", pytest.fail)
+
+    victims = shootings.ShootingVictimsData(ENDPOINT=local_server.url)
+    fingerprint = victims.get_fingerprint()
+    assert fingerprint["row_hash"] == "abc"
+    assert fingerprint["layers"] == {"zip_code": 123}
+
+    # Only the aggregate query and the edit date were requested
+    assert [request["path"] for request in local_server.requests] == [
+        "/",
+        "/zip_codes",
+    ]
+
+
+def raw_shootings(**columns):
+    """A page of raw shootings data, as downloaded from Carto."""
+
+    n = 2
+    df = gpd.GeoDataFrame(
+        dict(
+            cartodb_id=[1, 2],
+            objectid=[1, 2],
+            dc_key=["202301000001.0", "202301000002.0"],
+            officer_involved=["N"] * n,
+            date_=["2023-01-01T00:00:00Z", "2023-01-02T00:00:00Z"],
+            time=["12:30:00", "<Null>"],
+            race=["B", None],
+            latino=[0, 1],
+            sex=["M", "F"],
+            age=["25", None],
+            fatal=[1, 0],
+            point_x=[-75.16, -75.17],
+            point_y=[39.95, 39.96],
+        ),
+        geometry=gpd.points_from_xy([-75.16, -75.17], [39.95, 39.96]),
+        crs="EPSG:4326",
+    )
+    for name, values in columns.items():
+        df[name] = values
+    return df
+
+
+def test_format():
+    df = shootings.ShootingVictimsData().format(raw_shootings())
+
+    assert df["dc_key"].tolist() == ["202301000001", "202301000002"]
+    assert df["race"].tolist() == ["B", "H"]
+    assert df["age_group"].tolist() == ["18 to 30", "Unknown"]
+    assert df["sex"].dtype == "category"
+
+
+def test_format_rejects_unexpected_categories():
+    with pytest.raises(ValueError, match=r"'sex': \['U', 'X'\]"):
+        shootings.ShootingVictimsData().format(raw_shootings(sex=["X", "U"]))
+
+
+@pytest.fixture
+def saved_state(tmp_path, monkeypatch):
+    """Save enriched rows with a label, and load them back as the state."""
+
+    monkeypatch.setattr(shootings, "STATE_PATH", tmp_path / "state.fgb")
+    state = pd.DataFrame(
+        dict(
+            cartodb_id=[1, 2, 3],
+            row_hash=[10, 20, 30],
+            label=["a", "b", "c"],
+            x=[2690000.0, 2691000.0, np.nan],
+            y=[235000.0, 236000.0, np.nan],
+        )
+    )
+    shootings.save_enriched_state(state, dict(layers="v1"))
+    return shootings.load_enriched_state()
+
+
+def enrich_changed(state, version="v1"):
+    """Enrich a row that is unchanged, one that changed upstream and one
+    that was added, returning the output and the rows that were enriched."""
+
+    df = pd.DataFrame(dict(cartodb_id=[1, 2, 4], row_hash=[10, 99, 40]))
+    enriched = []
+
+    def func(df):
+        enriched.extend(df["cartodb_id"])
+        df["label"] = "new"
+
+    out = shootings.ShootingVictimsData().enrich_changed(
+        df, state, func, ["label"], "labels", version=("layers", version)
+    )
+    return out.sort_values("cartodb_id"), enriched
+
+
+def test_only_changed_rows_are_enriched(saved_state):
+    assert saved_state.attrs["versions"] == dict(layers="v1")
+
+    out, enriched = enrich_changed(saved_state)
+    assert sorted(enriched) == [2, 4]
+
+    # The removed row is dropped, and the unchanged row keeps its label
+    assert out["cartodb_id"].tolist() == [1, 2, 4]
+    assert out["label"].tolist() == ["a", "new", "new"]
+
+
+def test_all_rows_are_enriched_for_a_new_version(saved_state):
+    out, enriched = enrich_changed(saved_state, version="v2")
+    assert sorted(enriched) == [1, 2, 4]
+    assert out["label"].tolist() == ["new"] * 3
+
+
+def test_replay_saves_to_output_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(HTTP_RECORDER, "mode", "replay")
+    monkeypatch.setattr(HTTP_RECORDER, "path", tmp_path)
+    processed = {
+        path: path.stat().st_mtime_ns for path in shootings.DATA_DIR.rglob("*")
+    }
+
+    victims = shootings.ShootingVictimsData()
+    files = victims.save(shootings_output())
+    assert list(files) == ["shootings_2023.json"]
+
+    # Only the replay's outputs were saved
+    output = sorted(path.name for path in HTTP_RECORDER.output_dir.iterdir())
+    assert output == ["data_years.json", "shootings.fgb", "shootings_2023.json"]
+    assert {
+        path: path.stat().st_mtime_ns for path in shootings.DATA_DIR.rglob("*")
+    } == processed
+
+    # The checkpoints are kept apart too
+    assert victims.pipeline({}).path == HTTP_RECORDER.checkpoints_dir
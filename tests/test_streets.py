@@ -0,0 +1,109 @@
+"""Tests for matching shootings to street blocks."""
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from shapely.geometry import LineString, MultiLineString, Point
+
+from gun_violence_dashboard_data.streets import (
+    get_largest_contiguous_line,
+    get_largest_contiguous_lines,
+    match_to_nearest_segment,
+)
+
+
+def reference_nearest_segment(points, segments, max_distance):
+    """The nearest segment to each point, found like the original matching:
+    a spatial join with the buffered segments, falling back to the closest
+    of all segments for points outside every buffer.
+
+    Ties go to the segment with the lowest index.
+    """
+    points = gpd.GeoDataFrame(geometry=points)
+    buffered = gpd.GeoDataFrame(geometry=segments.buffer(max_distance))
+    joined = gpd.sjoin(points, buffered, predicate="within", how="left")
+
+    out = []
+    for i, point in enumerate(points.geometry):
+        candidates = joined.loc[[i], "index_right"].dropna().astype(int)
+        if not len(candidates):
+            candidates = segments.index
+        distance = segments.loc[candidates].distance(point)
+        out.append(distance.sort_index().idxmin())
+    return np.array(out)
+
+
+def test_matches_buffered_join():
+    segments = gpd.GeoSeries(
+        [
+            LineString([(0, 0), (1000, 0)]),
+            LineString([(0, 100), (1000, 100)]),
+            LineString([(2000, 0), (2000, 1000)]),
+        ]
+    )
+    points = gpd.GeoSeries(
+        [
+            Point(500, 10),  # close to one segment
+            Point(500, 70),  # within the distance of two segments
+            Point(500, 50),  # exactly between two segments
+            Point(1500, 500),  # outside the distance of every segment
+            Point(500, -400),  # far from everything
+        ]
+    )
+
+    segment_idx, distance, ties = match_to_nearest_segment(
+        points, segments, max_distance=200
+    )
+    expected = reference_nearest_segment(points, segments, max_distance=200)
+
+    assert segment_idx.tolist() == expected.tolist() == [0, 1, 0, 2, 0]
+    assert np.allclose(distance, [10, 30, 50, 500, 400])
+    assert ties.tolist() == [1, 1, 2, 1, 1]
+
+
+def test_missing_points_are_not_matched():
+    segments = gpd.GeoSeries([LineString([(0, 0), (1000, 0)])])
+    points = gpd.GeoSeries([Point(), None, Point(10, 10)])
+
+    segment_idx, distance, ties = match_to_nearest_segment(
+        points, segments, max_distance=200
+    )
+    assert segment_idx.tolist() == [-1, -1, 0]
+    assert pd.isnull(distance[:2]).all()
+    assert ties.tolist() == [0, 0, 1]
+
+
+def test_largest_contiguous_lines_match_per_block():
+    lines = gpd.GeoSeries(
+        [
+            # Disjoint: a short part, and a longer part of two connected lines
+            LineString([(0, 0), (10, 0)]),
+            LineString([(100, 0), (150, 0)]),
+            LineString([(150, 0), (200, 0)]),
+            # A single segment
+            LineString([(0, 100), (50, 100)]),
+            # Disjoint parts of the same length
+            LineString([(0, 200), (10, 200)]),
+            LineString([(50, 200), (60, 200)]),
+        ]
+    )
+    groups = np.array([0, 0, 0, 1, 2, 2])
+
+    out = get_largest_contiguous_lines(lines, groups)
+    expected = lines.groupby(groups).agg(get_largest_contiguous_line).values
+
+    assert shapely.equals(out, expected).all()
+    assert shapely.length(out).tolist() == [100, 50, 10]
+
+
+def test_largest_contiguous_lines_requires_linestrings():
+    lines = gpd.GeoSeries(
+        [
+            LineString([(0, 0), (10, 0)]),
+            MultiLineString([[(0, 0), (10, 0)], [(20, 0), (30, 0)]]),
+        ]
+    )
+    with pytest.raises(ValueError, match="Only LineString geometries"):
+        get_largest_contiguous_lines(lines, [0, 1])
@@ -0,0 +1,111 @@
+"""Tests for validating data against a pydantic schema."""
+
+from dataclasses import dataclass
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from pydantic import ValidationError
+from shapely.geometry import LineString, Point
+
+from gun_violence_dashboard_data.shootings import (
+    ShootingVictimsSchema,
+    verify_dc_key_column,
+)
+from gun_violence_dashboard_data.utils import (
+    MAX_REPORTED_ERRORS,
+    validate_columns,
+    validate_data_schema,
+)
+
+
+def shootings_output(n=3):
+    """A valid frame of processed shootings."""
+
+    return gpd.GeoDataFrame(
+        dict(
+            dc_key=[str(202301000000 + i) for i in range(n)],
+            race=pd.Categorical(np.resize(["B", "H", "W", "A"], n)),
+            sex=np.resize(["M", "F"], n),
+            fatal=[i % 2 == 0 for i in range(n)],
+            date=pd.date_range("2023-01-01", periods=n, freq="h"),
+            age_group=["18 to 30"] * n,
+            has_court_case=[False] * n,
+            age=[25.0] * (n - 1) + [np.nan],
+            zip_code=["19104"] * (n - 1) + [None],
+        ),
+        geometry=[Point(-75.16, 39.95)] * n,
+        crs="EPSG:4326",
+    )
+
+
+@dataclass
+class Output:
+    """Return a frame, validated like `ShootingVictimsData.validate`."""
+
+    df: pd.DataFrame
+    strict_rowwise: bool = False
+
+    @validate_data_schema(
+        ShootingVictimsSchema, column_validators={"dc_key": verify_dc_key_column}
+    )
+    def get(self):
+        return self.df
+
+
+def with_value(column, value, row=1):
+    """A valid frame, with one value replaced."""
+
+    df = shootings_output()
+    df[column] = df[column].astype(object)
+    df.loc[row, column] = value
+    return df
+
+
+FRAMES = {
+    "valid": shootings_output(),
+    "unexpected literal": with_value("race", "Z"),
+    "null required field": with_value("sex", None),
+    "bad dc_key": with_value("dc_key", "202301000001.0"),
+    "bad float": with_value("age", "abc"),
+    "bad datetime": with_value("date", "abc"),
+    "bad geometry": with_value("geometry", LineString([(0, 0), (1, 1)])),
+    "missing column": shootings_output().drop(columns=["sex"]),
+}
+
+
+@pytest.mark.parametrize("name", FRAMES)
+def test_columns_as_strict_as_rows(name):
+    df = FRAMES[name]
+
+    results = []
+    for strict_rowwise in [False, True]:
+        try:
+            Output(df, strict_rowwise=strict_rowwise).get()
+            results.append(True)
+        except (ValueError, ValidationError):
+            results.append(False)
+
+    assert results[0] == results[1]
+    assert results[0] == (name == "valid")
+
+
+def test_errors_name_row_and_field():
+    with pytest.raises(ValueError) as e:
+        validate_columns(with_value("race", "Z", row=2), ShootingVictimsSchema)
+
+    assert "1 validation error(s) for ShootingVictimsSchema" in str(e.value)
+    assert "row 2, field 'race': unexpected value" in str(e.value)
+
+
+def test_reported_errors_are_capped():
+    df = shootings_output(n=30)
+    df["sex"] = "X"
+
+    with pytest.raises(ValueError) as e:
+        validate_columns(df, ShootingVictimsSchema)
+
+    lines = str(e.value).splitlines()[1:]
+    assert len(lines) == MAX_REPORTED_ERRORS + 1
+    assert lines[-1] == "field 'sex': 30 invalid rows in total"